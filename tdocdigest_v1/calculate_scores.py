@@ -2,31 +2,31 @@
 This file calculate the score for the generated summary compared to original text
 """
 import logging
-import openai
-import os
+import re
+import time
+import argparse
+from manage_common import format_openai_error
+from manage_apikeys import acquire_api_key, release_api_key, get_openai_client, get_async_openai_client
+
+# Criteria in the rating prompt (see build_score_messages)
+SCORE_CRITERIA = ['relevance', 'coherence', 'completeness', 'conciseness', 'overall']
+
+# Number of samples and temperature of the multi-sample scoring
+SCORE_SAMPLES = 5
+SCORE_SAMPLES_TEMPERATURE = 0.7
 
 # from bert_score import score
 
 
-# Calculate the score (semantic) using the summary with gpt model
-def calculate_semantic_score(tdocsummarytxt, tdoctxt, userkey, model):
+# Build the rating prompt messages for the summary
+def build_score_messages(tdocsummarytxt, tdoctxt):
     """
-    Generate a semantic score for the given abstractive summary. Prompt specifies the score style
+    Build the chat messages used for rating a generated summary
+    The same messages are used for interactive requests and batch request files
     :param tdocsummarytxt: summary text
     :param tdoctxt: original long text
-    :param userkey: API key for gpt-4o
-    :param model: openai model (gpt-4o)
-    :return: Score in the following format
-                Relevance: [score]/10
-                Coherence: [score]/10
-                Completeness: [score]/10
-                Conciseness: [score]/10
-                Overall: [score]/10
+    :return messages (list): chat completion messages
     """
-    # openai.api_key = userkey
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-
-    logging.info(f'Calculate semantic score')
     # Rating prompt for OpenAI API
     prompt = f""" Given the following original text and its generated summary, please evaluate the quality of the 
     summary based on four criteria: relevance, coherence, completeness, and conciseness. For each criterion, 
@@ -45,16 +45,105 @@ def calculate_semantic_score(tdocsummarytxt, tdoctxt, userkey, model):
       Conciseness: [score]/10
       Overall: [score]/10
   """
-    err = ''
+
+    return [{"role": "user", "content": prompt}]
+
+
+def parse_score_criteria(ratingsummary):
+    """
+    Parse the scores of all criteria from a rating
+    Accepts variations of the requested format, for example '**Relevance:** 8/10', 'Coherence - 7.5 / 10',
+    'Overall Rating: 8/10', 'Overall (8/10)'
+    :param ratingsummary (str): rating text in the format of calculate_semantic_score
+    :return scores (dict): criterion -> score (float), criteria not found are not included
+    """
+    scores = {}
+    # Optional words between the criterion and the score (for example 'Overall Rating: 8/10'), the score can also
+    # be in parentheses (for example 'Overall (8/10)')
+    for match in re.finditer(r'(' + '|'.join(SCORE_CRITERIA) + r')(?:\W{1,4}(?:rating|score|grade|mark))?'
+                             r'\W{0,6}?[:\-=(]\W{0,4}?(\d+(?:\.\d+)?)(?:\s*/\s*(\d+))?',
+                             ratingsummary, re.IGNORECASE):
+        criterion = match.group(1).lower()
+        score = float(match.group(2))
+        # Scores on another scale (for example 4/5) are converted to a scale of 10
+        if match.group(3) and float(match.group(3)) not in (0, 10):
+            score = score * 10 / float(match.group(3))
+        if criterion not in scores and 0 <= score <= 10:
+            scores[criterion] = score
+
+    return scores
+
+
+def get_overall_score(ratingsummary):
+    """
+    Get the overall score from the rating returned by calculate_semantic_score
+    :param ratingsummary (str): rating text in the format of calculate_semantic_score
+    :return overall_score (str): overall score (for example 8/10), empty string if not found
+    """
+    scores = parse_score_criteria(ratingsummary)
+    if 'overall' not in scores:
+        return ''
+
+    return f"{scores['overall']:g}/10"
+
+
+def aggregate_scores(samples):
+    """
+    Aggregate the scores of several ratings of the same summary
+    Agreement is the fraction of the samples within 1 point of the median of the criterion.
+    :param samples (list): scores from parse_score_criteria (one dict per sample)
+    :return statistics (dict): criterion -> {'mean', 'variance', 'agreement', 'samples'}
+    """
+    statistics = {}
+    for criterion in SCORE_CRITERIA:
+        values = sorted(sample[criterion] for sample in samples if criterion in sample)
+        if not values:
+            continue
+        mean = sum(values) / len(values)
+        middle = len(values) // 2
+        median = values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+        statistics[criterion] = {
+            'mean': mean,
+            'variance': sum((value - mean) ** 2 for value in values) / len(values),
+            'agreement': sum(1 for value in values if abs(value - median) <= 1) / len(values),
+            'samples': values,
+        }
+
+    return statistics
+
+
+# Calculate the score (semantic) using the summary with gpt model
+def calculate_semantic_score(tdocsummarytxt, tdoctxt, userkey, model):
+    """
+    Generate a semantic score for the given abstractive summary. Prompt specifies the score style
+    :param tdocsummarytxt: summary text
+    :param tdoctxt: original long text
+    :param userkey: API key for gpt-4o
+    :param model: openai model (gpt-4o)
+    :return: Score in the following format
+                Relevance: [score]/10
+                Coherence: [score]/10
+                Completeness: [score]/10
+                Conciseness: [score]/10
+                Overall: [score]/10
+    """
+    # Least loaded key of the key pool (userkey is not used)
+    apikey, err = acquire_api_key()
+    if err != '':
+        return '', err
+
+    logging.info(f'Calculate semantic score')
     ratingsummary = ''
+    response_summary_rating = None
 
     try:
         # Send the prompt to OpenAI API
-        response_summary_rating = openai.chat.completions.create(
+        response_summary_rating = get_openai_client(apikey).chat.completions.create(
             model=model,
-            messages=[{"role": "user", "content": prompt}],  # the messages format
+            messages=build_score_messages(tdocsummarytxt, tdoctxt),  # the messages format
             temperature=0.01  # Set to a low temperature for more consistent ratings
         )
+        release_api_key(apikey, response_summary_rating)
 
         # Extract the response content
         ratingsummary = response_summary_rating.choices[0].message.content
@@ -64,24 +153,138 @@ def calculate_semantic_score(tdocsummarytxt, tdoctxt, userkey, model):
         return ratingsummary, err
 
     except Exception as e:
-        err = str(e)
-        logging.error(f"OpenAI API returned an error: {err}")
-        if "authentication" in err.lower():
-            err = f"Authentication failed. Check your API key. {err}"
-            logging.error(err)
-        if "rate limit" in err.lower():
-            err = f"Rate limit exceeded. Try again later. {err}"
-            logging.error(err)
-        if "invalid" in err.lower():
-            err = f"The request was invalid. Check your parameters. {err}"
-            logging.error(err)
-        else:
-            err = f"An unexpected OpenAI error occurred.{err}"
-            logging.error(err)
+        if response_summary_rating is None:
+            release_api_key(apikey, exception=e)
+        err = format_openai_error(e)
+
+        return ratingsummary, err
+
+
+async def calculate_semantic_score_async(tdocsummarytxt, tdoctxt, userkey, model):
+    """
+    Same as calculate_semantic_score with the async OpenAI client
+    :param tdocsummarytxt: summary text
+    :param tdoctxt: original long text
+    :param userkey: API key for gpt-4o
+    :param model: openai model (gpt-4o)
+    :return: Score in the format of calculate_semantic_score
+    """
+    apikey, err = acquire_api_key()
+    if err != '':
+        return '', err
+
+    logging.info(f'Calculate semantic score')
+    ratingsummary = ''
+    response_summary_rating = None
+
+    try:
+        response_summary_rating = await get_async_openai_client(apikey).chat.completions.create(
+            model=model,
+            messages=build_score_messages(tdocsummarytxt, tdoctxt),
+            temperature=0.01
+        )
+        release_api_key(apikey, response_summary_rating)
+
+        ratingsummary = response_summary_rating.choices[0].message.content
+        logging.info(f'Rating summary {ratingsummary}')
+
+        return ratingsummary, err
+
+    except Exception as e:
+        if response_summary_rating is None:
+            release_api_key(apikey, exception=e)
+        err = format_openai_error(e)
 
         return ratingsummary, err
 
 
+def calculate_semantic_score_samples(tdocsummarytxt, tdoctxt, userkey, model, nsamples=SCORE_SAMPLES,
+                                     temperature=SCORE_SAMPLES_TEMPERATURE):
+    """
+    Generate nsamples ratings of the summary in one API call (the TDoc is sent once) and aggregate them
+    :param tdocsummarytxt: summary text
+    :param tdoctxt: original long text
+    :param userkey: API key for gpt-4o
+    :param model: openai model (gpt-4o)
+    :param nsamples (int): number of ratings
+    :param temperature (float): temperature of the ratings (higher than the single rating to get varied samples)
+    :return statistics (dict): criterion -> {'mean', 'variance', 'agreement', 'samples'} (see aggregate_scores)
+    :return err (str): any errors during the processing
+    """
+    apikey, err = acquire_api_key()
+    if err != '':
+        return {}, err
+
+    logging.info(f'Calculate semantic score with {nsamples} samples')
+    statistics = {}
+    response_summary_rating = None
+
+    try:
+        response_summary_rating = get_openai_client(apikey).chat.completions.create(
+            model=model,
+            messages=build_score_messages(tdocsummarytxt, tdoctxt),
+            temperature=temperature,
+            n=nsamples
+        )
+        release_api_key(apikey, response_summary_rating)
+
+        samples = [parse_score_criteria(choice.message.content) for choice in response_summary_rating.choices]
+        samples = [sample for sample in samples if sample]
+        if not samples:
+            err = "No score found in the ratings"
+            logging.error(err)
+            return statistics, err
+
+        statistics = aggregate_scores(samples)
+        logging.info(f'Rating statistics {statistics}')
+
+        return statistics, err
+
+    except Exception as e:
+        if response_summary_rating is None:
+            release_api_key(apikey, exception=e)
+        err = format_openai_error(e)
+
+        return statistics, err
+
+
+def compare_scoring_throughput(tdocsummarytxt, tdoctxt, model, nsamples=SCORE_SAMPLES):
+    """
+    Compare nsamples ratings in one API call with nsamples separate API calls (time and tokens)
+    :param tdocsummarytxt: summary text
+    :param tdoctxt: original long text
+    :param model: openai model (gpt-4o)
+    :param nsamples (int): number of ratings
+    :return comparison (dict): 'single_call' and 'separate_calls' -> {'seconds', 'prompt_tokens',
+                               'completion_tokens', 'samples'}
+    """
+    messages = build_score_messages(tdocsummarytxt, tdoctxt)
+
+    comparison = {}
+    for name, calls, samples_per_call in [('single_call', 1, nsamples), ('separate_calls', nsamples, 1)]:
+        result = {'seconds': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0, 'samples': 0}
+        start_time = time.perf_counter()
+        for _ in range(calls):
+            apikey, err = acquire_api_key()
+            if err != '':
+                raise RuntimeError(err)
+            try:
+                response = get_openai_client(apikey).chat.completions.create(
+                    model=model, messages=messages, temperature=SCORE_SAMPLES_TEMPERATURE, n=samples_per_call)
+            except Exception as e:
+                release_api_key(apikey, exception=e)
+                raise
+            release_api_key(apikey, response)
+            result['prompt_tokens'] += response.usage.prompt_tokens
+            result['completion_tokens'] += response.usage.completion_tokens
+            result['samples'] += sum(1 for choice in response.choices if parse_score_criteria(choice.message.content))
+        result['seconds'] = time.perf_counter() - start_time
+        comparison[name] = result
+        logging.info(f"Scoring {name}: {result}")
+
+    return comparison
+
+
 # Compute the BERT score
 def calculate_bert_score(tdoc_summary_txt, tdoc_txt):
     # Calculate BERTScore
@@ -95,3 +298,20 @@ def calculate_bert_score(tdoc_summary_txt, tdoc_txt):
     logging.info(f"Precision:{p_mean}, Recall: {r_mean}, F1 Score: {f1_mean}")
 
     return p_mean, r_mean, f1_mean
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare multi-sample scoring in one call with separate calls')
+    parser.add_argument('summaryfile', help='text file with the summary')
+    parser.add_argument('tdocfile', help='text file with the original TDoc text')
+    parser.add_argument('--samples', type=int, default=SCORE_SAMPLES)
+    parser.add_argument('--model', default='gpt-4')
+    args = parser.parse_args()
+
+    with open(args.summaryfile, 'r', encoding='utf-8') as summary_file, \
+            open(args.tdocfile, 'r', encoding='utf-8') as tdoc_file:
+        scoring = compare_scoring_throughput(summary_file.read(), tdoc_file.read(), args.model, args.samples)
+    for scoring_mode, scoring_result in scoring.items():
+        print(f"{scoring_mode}: {scoring_result['seconds']:.2f}s, {scoring_result['prompt_tokens']} prompt tokens, "
+              f"{scoring_result['completion_tokens']} completion tokens, {scoring_result['samples']} samples, "
+              f"{scoring_result['samples'] / scoring_result['seconds']:.2f} samples/s")
@@ -0,0 +1,198 @@
+"""
+This file handles the extraction of proposals and observations for the TDoc Digest
+RAN1 contributions list numbered items such as 'Proposal 1: ...' and 'Observation 2: ...'.
+The items are extracted locally (no API call) and saved in a per-meeting index for searching.
+"""
+import os
+import re
+import logging
+import pickle
+import threading
+import argparse
+from manage_common import get_file_path
+from handle_datafiles import create_data_folder
+
+# Start of a numbered item, for example 'Proposal 1:', 'Observation 2-1.', 'Proposal 3a:', 'Proposal 2 Support ...'
+# (without a separator, the text starts with a capital letter: 'Proposal 2 is ...' is a sentence)
+ITEM_PATTERN = re.compile(r'^\s*(proposal|observation)\s*#?\s*(\d+[a-z]?(?:[-.]\d+)*)'
+                          r'(?:\s*[:\uff1a.)]\s*|\s+(?=(?-i:[A-Z])))(.*)$', re.IGNORECASE)
+
+# Section heading, for example '2.1 Beam management' or 'Conclusion'
+HEADING_PATTERN = re.compile(r'^\s*(\d+(\.\d+)*\.?\s+\S.*|references|conclusions?|summary)\s*$', re.IGNORECASE)
+
+# Continuation of an item, for example bullets, alternatives ('Alt 1:', 'Option 2)'), 'FFS' and notes ('Note 1:')
+CONTINUATION_PATTERN = re.compile(r'^\s*([-\u2022\u2013*]|[a-z]\)|\(?[ivx]+\)'
+                                  r'|(alt(ernative)?|option)\.?\s*[-#]?\s*(\d+[a-z]?(?:[-.]\d+)*|[a-z])\s*[:\uff1a.)]'
+                                  r'|ffs\b|note\s*\d*\s*[:\uff1a])', re.IGNORECASE)
+
+# Maximum number of characters kept from the explanation before an item
+MAX_EXPLANATION_LENGTH = 1000
+
+# Number of characters from the start of the TDoc sent with the extracted items (title, source, agenda item)
+SUMMARY_HEADER_LENGTH = 1500
+
+# Index files are read and written by concurrent requests
+index_lock = threading.Lock()
+
+
+def extract_items(inputtext):
+    """
+    Extracts the numbered proposals and observations with their explanation from the text of a TDoc
+    The explanation is the text before the item (back to the previous item or section heading).
+    Items repeated in the conclusion are kept once.
+    :param inputtext (str): the text of the TDoc (from get_tdoc_content)
+    :return items (list): dicts with kind ('proposal' or 'observation'), number, text and explanation
+    """
+    paragraphs = [paragraph.strip() for paragraph in inputtext.splitlines() if paragraph.strip()]
+
+    items = []
+    found = {}
+    explanation = []
+    current = None
+    for paragraph in paragraphs:
+        match = ITEM_PATTERN.match(paragraph)
+        if match:
+            kind = match.group(1).lower()
+            number = match.group(2)
+            item_explanation = ' '.join(explanation)[-MAX_EXPLANATION_LENGTH:]
+            explanation = []
+
+            key = (kind, number)
+            if key in found:
+                # Repeated item (usually the conclusion), keep the first one
+                current = None
+                if not found[key]['explanation']:
+                    found[key]['explanation'] = item_explanation
+                continue
+
+            current = {'kind': kind, 'number': number, 'text': match.group(3), 'explanation': item_explanation}
+            found[key] = current
+            items.append(current)
+            continue
+
+        if current is not None and (CONTINUATION_PATTERN.match(paragraph) or current['text'] == ''):
+            # Bullets and alternatives belong to the item
+            current['text'] = (current['text'] + '\n' + paragraph).strip()
+            continue
+
+        current = None
+        if HEADING_PATTERN.match(paragraph) and len(paragraph) < 100:
+            explanation = []
+        else:
+            explanation.append(paragraph)
+
+    logging.debug(f'Extracted {len(items)} proposals and observations')
+    return items
+
+
+def format_extracted_items(items):
+    """
+    Formats the extracted items as text (used in the summary prompt)
+    :param items (list): items from extract_items
+    :return (str): one paragraph per item
+    """
+    lines = []
+    for item in items:
+        line = f"{item['kind'].capitalize()} {item['number']}: {item['text']}"
+        if item['explanation']:
+            line += f"\nExplanation: {item['explanation']}"
+        lines.append(line)
+
+    return '\n\n'.join(lines)
+
+
+def get_item_index_file(datafolder, meetingid):
+    """
+    Returns the file where the proposal and observation index of the meeting is saved
+    :param datafolder (str): data folder
+    :param meetingid (str): meeting id
+    :return (str): index file full path
+    """
+    return get_file_path(datafolder, 'items_' + meetingid + '.pkl')
+
+
+def load_item_index(meetingid):
+    """
+    Loads the proposal and observation index of the meeting
+    :param meetingid (str): meeting id
+    :return index (dict): tdoc number -> {'agenda_item': agenda item, 'items': items from extract_items}
+    """
+    index_file = get_item_index_file(create_data_folder(), meetingid)
+    if not os.path.exists(index_file):
+        return {}
+
+    try:
+        with open(index_file, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logging.error(f"Error loading the index {index_file}: {e}")
+        return {}
+
+
+def update_item_index(meetingid, tdocnumber, inputtext, agendaitem=''):
+    """
+    Extracts the proposals and observations of the TDoc and saves them in the index of the meeting
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param inputtext (str): the text of the TDoc
+    :param agendaitem (str): agenda item of the TDoc
+    :return items (list): items from extract_items
+    """
+    items = extract_items(inputtext)
+    index_file = get_item_index_file(create_data_folder(), meetingid)
+
+    with index_lock:
+        index = load_item_index(meetingid)
+        index[tdocnumber] = {'agenda_item': agendaitem, 'items': items}
+
+        # Written to a temporary file first so that a failure does not corrupt the index
+        temp_file = index_file + '.tmp'
+        with open(temp_file, 'wb') as file:
+            pickle.dump(index, file)
+        os.replace(temp_file, index_file)
+
+    logging.info(f"Index {index_file} updated: {tdocnumber}, {len(items)} items")
+    return items
+
+
+def query_item_index(meetingid, keyword='', agendaitem='', kind=''):
+    """
+    Searches the proposals and observations of the meeting (no API call)
+    Example: query_item_index('118', keyword='SBFD', agendaitem='9.x', kind='proposal')
+    :param meetingid (str): meeting id
+    :param keyword (str): text searched in the item and its explanation (case insensitive)
+    :param agendaitem (str): agenda item or agenda item prefix ('9', '9.x' and '9.*' match 9.1, 9.1.2 etc.)
+    :param kind (str): 'proposal' or 'observation'
+    :return results (list): items with tdoc number and agenda item added
+    """
+    agenda_prefix = re.sub(r'\.[x*]$', '', agendaitem.strip().lower())
+    keyword = keyword.lower()
+    kind = kind.lower()
+
+    results = []
+    for tdocnumber, tdoc in sorted(load_item_index(meetingid).items()):
+        tdoc_agenda_item = tdoc['agenda_item']
+        if agenda_prefix and not (tdoc_agenda_item == agenda_prefix or
+                                  tdoc_agenda_item.startswith(agenda_prefix + '.')):
+            continue
+        for item in tdoc['items']:
+            if kind and item['kind'] != kind:
+                continue
+            if keyword and keyword not in item['text'].lower() and keyword not in item['explanation'].lower():
+                continue
+            results.append(dict(item, tdoc_number=tdocnumber, agenda_item=tdoc_agenda_item))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest search of proposals and observations')
+    parser.add_argument('meetingid')
+    parser.add_argument('--keyword', default='')
+    parser.add_argument('--agenda', default='', help="agenda item or prefix, for example 9.x")
+    parser.add_argument('--kind', choices=['proposal', 'observation'], default='')
+    args = parser.parse_args()
+
+    for result in query_item_index(args.meetingid, args.keyword, args.agenda, args.kind):
+        print(f"{result['tdoc_number']} (AI {result['agenda_item']}) "
+              f"{result['kind'].capitalize()} {result['number']}: {result['text']}")
@@ -0,0 +1,354 @@
+"""
+This file handles the meeting digest for the TDoc Digest
+The summaries of the TDocs of a meeting are grouped by agenda item and reduced hierarchically per agenda item.
+The digest is incremental: only the agenda items (and the reduce steps) with new or changed TDocs are recomputed.
+"""
+import os
+import glob
+import hashlib
+import logging
+import pickle
+import argparse
+from manage_common import get_file_path, parse_agenda_item
+from handle_datafiles import create_data_folder
+from manage_apikeys import acquire_api_key, release_api_key, get_openai_client
+
+# Number of summaries (or partial digests) reduced together in one step
+DIGEST_GROUP_SIZE = 8
+
+# Agenda item used when the agenda item of a TDoc is not found
+UNKNOWN_AGENDA_ITEM = 'unknown'
+
+# Length of the timestamp in the data file names (%Y%m%d_%H%M%S)
+DATA_FILE_TIME_STAMP_LENGTH = 15
+
+
+def get_text_hash(*texts):
+    """
+    Returns a hash of the given texts, used to detect new or changed summaries
+    :param texts (str): texts to be hashed
+    :return (str): hex digest
+    """
+    text_hash = hashlib.sha256()
+    for text in texts:
+        text_hash.update(text.encode('utf-8'))
+        text_hash.update(b'\0')
+
+    return text_hash.hexdigest()
+
+
+def load_meeting_summaries(datafolder, meetingid):
+    """
+    Loads the latest summary of each TDoc of the meeting from the data files
+    Data file format is data_<meetingid>_<tdocnumber>_<timestamp>.pkl (see create_data_file)
+    :param datafolder (str): data folder
+    :param meetingid (str): meeting id
+    :return summaries (dict): tdoc number -> {'summary': summary text, 'agenda_item': agenda item}
+    """
+    prefix = 'data_' + meetingid + '_'
+    latest = {}
+    for data_filename in glob.glob(get_file_path(datafolder, prefix + '*.pkl')):
+        name = os.path.basename(data_filename)[:-len('.pkl')]
+        tdocnumber = name[len(prefix):-(DATA_FILE_TIME_STAMP_LENGTH + 1)]
+        file_time_stamp = name[-DATA_FILE_TIME_STAMP_LENGTH:]
+        if tdocnumber == '':
+            continue
+        if tdocnumber not in latest or latest[tdocnumber][0] < file_time_stamp:
+            latest[tdocnumber] = (file_time_stamp, data_filename)
+
+    summaries = {}
+    for tdocnumber, (_, data_filename) in latest.items():
+        try:
+            with open(data_filename, 'rb') as file:
+                session_data = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logging.error(f"Error loading data file {data_filename}: {e}")
+            continue
+
+        summary = session_data.get('tdoc_summary_txt', '')
+        if session_data.get('error') or not summary:
+            continue
+
+        # Agenda item from the document metadata, otherwise from the summary header
+        agenda_item = session_data.get('agenda_item') or parse_agenda_item(summary) or UNKNOWN_AGENDA_ITEM
+        summaries[tdocnumber] = {'summary': summary, 'agenda_item': agenda_item}
+
+    logging.info(f"Loaded {len(summaries)} summaries for meeting {meetingid}")
+    return summaries
+
+
+def get_digest_state_file(datafolder, meetingid):
+    """
+    Returns the file where the digest state of the meeting is saved
+    :param datafolder (str): data folder
+    :param meetingid (str): meeting id
+    :return (str): digest state file full path
+    """
+    return get_file_path(datafolder, 'digest_' + meetingid + '.pkl')
+
+
+def load_digest_state(statefile):
+    """
+    Loads the digest state saved by save_digest_state
+    :param statefile (str): digest state file full path
+    :return state (dict): {'items': agenda item -> {'fingerprint', 'tdocs', 'digest'},
+                           'nodes': reduce step hash -> partial digest}
+    """
+    state = {'items': {}, 'nodes': {}}
+    if os.path.exists(statefile):
+        try:
+            with open(statefile, 'rb') as file:
+                state = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logging.error(f"Error loading digest state {statefile}, digest is rebuilt: {e}")
+
+    return state
+
+
+def save_digest_state(statefile, state):
+    """
+    Saves the digest state (written to a temporary file first so that a failure does not corrupt the state)
+    :param statefile (str): digest state file full path
+    :param state (dict): digest state
+    :return: None
+    """
+    temp_file = statefile + '.tmp'
+    with open(temp_file, 'wb') as file:
+        pickle.dump(state, file)
+    os.replace(temp_file, statefile)
+
+
+def generate_openai_digest(texts, agendaitem, temperature=0.1, model='gpt-4'):
+    """
+    Reduce the summaries (or partial digests) of an agenda item into one digest using the gpt-4o API.
+    :param texts (list): summaries or partial digests
+    :param agendaitem (str): agenda item of the summaries
+    :param temperature (float): the temperature of the gpt-4o API
+    :param model (str): the gpt-4o model to generate the digest from
+    :return digest (str): the digest generated from gpt-4o API
+    :return err (str): any errors during the processing
+    """
+    digest = ''
+    # Least loaded key of the key pool
+    apikey, err = acquire_api_key()
+    if err != '':
+        return digest, err
+
+    response_openai = None
+    try:
+        response_openai = get_openai_client(apikey).chat.completions.create(
+            messages=[
+                {"role": "system",
+                 "content": "You are acting as a 3GPP Standard Delegate specializing in the RAN (Radio Access "
+                            "Network) Working Group 1 (WG1) for 5G/6G standardization. Combine the following "
+                            f"summaries of contributions to agenda item {agendaitem} into one digest using terms "
+                            "common in 3GPP. Group similar proposals and observations, keep the document numbers "
+                            "and sources of each proposal and highlight where the companies agree or differ."},
+                {"role": "user", "content": "\n\n".join(texts)}
+            ],
+            model=model,
+            temperature=temperature,
+        )
+        release_api_key(apikey, response_openai)
+        digest = response_openai.choices[0].message.content
+        logging.info(f"Digest generated for agenda item {agendaitem} from {len(texts)} texts")
+
+    except Exception as e:
+        if response_openai is None:
+            release_api_key(apikey, exception=e)
+        err = f"OpenAI API returned an error while generating the digest: {e}"
+        logging.error(err)
+
+    return digest, err
+
+
+def reduce_texts(texts, agendaitem, callapi):
+    """
+    Reduce step of the digest. If callapi is False, the texts are concatenated and
+    the first 2000 characters are returned (for debugging purposes)
+    :param texts (list): summaries or partial digests
+    :param agendaitem (str): agenda item of the summaries
+    :param callapi (bool): Whether to call the gpt-4o API (prompt) or not
+    :return digest (str): the reduced text
+    :return err (str): any errors during the processing
+    """
+    if not callapi:
+        return "\n\n".join(texts)[0:2000], ''
+
+    return generate_openai_digest(texts, agendaitem)
+
+
+def split_blocks(keys, groupsize, level):
+    """
+    Splits the sorted keys into blocks of at most groupsize keys (content defined)
+    A block ends at a key whose hash is a boundary (once the block has groupsize // 2 keys), so the blocks only
+    depend on the neighbouring keys: adding a key changes its block and rarely the next one.
+    :param keys (list): sorted tdoc numbers (first tdoc number of each partial digest above the leaves)
+    :param groupsize (int): maximum number of keys in a block
+    :param level (int): level of the reduce tree (0 for the summaries), the boundaries differ at each level
+    :return blocks (list): lists of consecutive keys
+    """
+    minsize = max(2, groupsize // 2)
+    blocks = [[]]
+    for key in keys:
+        blocks[-1].append(key)
+        if len(blocks[-1]) >= groupsize or \
+                (len(blocks[-1]) >= minsize and int(get_text_hash(str(level), key), 16) % minsize == 0):
+            blocks.append([])
+    if not blocks[-1]:
+        blocks.pop()
+    # A short last block is merged into the previous block when they fit in one group
+    if len(blocks) > 1 and len(blocks[-1]) + len(blocks[-2]) <= groupsize:
+        blocks[-2] += blocks.pop()
+
+    return blocks
+
+
+def reduce_group(texts, agendaitem, nodes, usednodes, reducefn):
+    """
+    One reduce step: reduce the texts into one digest, a single text is its own digest (no reduce step)
+    :param texts (list): summaries or partial digests
+    :param agendaitem (str): agenda item of the summaries
+    :param nodes (dict): reduce step hash -> partial digest (from the previous digest)
+    :param usednodes (dict): reduce steps used in this digest (updated)
+    :param reducefn (callable): function (texts, agendaitem) -> (digest, err)
+    :return digest (str): digest of the texts
+    :return recomputed (int): 1 if the reduce step was computed (not taken from the cache), otherwise 0
+    :return err (str): any errors during the processing
+    """
+    if len(texts) == 1:
+        return texts[0], 0, ''
+
+    node_hash = get_text_hash(agendaitem, *texts)
+    if node_hash in nodes:
+        usednodes[node_hash] = nodes[node_hash]
+        return nodes[node_hash], 0, ''
+
+    digest, err = reducefn(texts, agendaitem)
+    if err != '':
+        return '', 1, err
+    usednodes[node_hash] = digest
+
+    return digest, 1, ''
+
+
+def reduce_hierarchically(tdocs, agendaitem, nodes, usednodes, reducefn, groupsize):
+    """
+    Reduce the summaries in a tree of groups of at most groupsize until one digest remains
+    Up to groupsize summaries are reduced together. More summaries are split in blocks of consecutive tdoc numbers
+    (split_blocks), each block is reduced and the partial digests are split and reduced the same way.
+    The result of each reduce step is cached in nodes using the hash of its input texts. The blocks only depend on
+    the neighbouring tdocs, so a new TDoc only changes the reduce steps on its path.
+    :param tdocs (dict): tdoc number -> summary
+    :param agendaitem (str): agenda item of the summaries
+    :param nodes (dict): reduce step hash -> partial digest (from the previous digest)
+    :param usednodes (dict): reduce steps used in this digest (updated)
+    :param reducefn (callable): function (texts, agendaitem) -> (digest, err)
+    :param groupsize (int): number of texts reduced together
+    :return digest (str): digest of the summaries
+    :return recomputed (int): number of reduce steps computed (not taken from the cache)
+    :return err (str): any errors during the processing
+    """
+    recomputed = 0
+    # (first tdoc number, text) of each summary, then of each partial digest
+    items = [(tdocnumber, tdocnumber + '\n' + tdocs[tdocnumber]) for tdocnumber in sorted(tdocs)]
+    level = 0
+    while len(items) > groupsize >= 2:
+        texts = dict(items)
+        partials = []
+        for block in split_blocks([key for key, _ in items], groupsize, level):
+            partial, steps, err = reduce_group([texts[key] for key in block], agendaitem, nodes, usednodes,
+                                               reducefn)
+            recomputed += steps
+            if err != '':
+                return '', recomputed, err
+            partials.append((block[0], partial))
+        items = partials
+        level += 1
+
+    digest, steps, err = reduce_group([text for _, text in items], agendaitem, nodes, usednodes, reducefn)
+
+    return digest, recomputed + steps, err
+
+
+def build_meeting_digest(meetingid, callapi=False, reducefn=None, groupsize=DIGEST_GROUP_SIZE):
+    """
+    Builds (or updates) the digest of the meeting, one digest per agenda item
+    Only the agenda items with new or changed TDocs are recomputed. The digest state is saved in the data folder.
+    :param meetingid (str): meeting id
+    :param callapi (bool): Whether to call the gpt-4o API (prompt) or not (ignored if reducefn is given)
+    :param reducefn (callable): function (texts, agendaitem) -> (digest, err) used for each reduce step
+    :param groupsize (int): number of texts reduced together
+    :return digests (dict): agenda item -> digest
+    :return recomputed (list): agenda items recomputed in this call
+    :return errors (dict): agenda item -> error string for the agenda items which could not be updated
+    """
+    if reducefn is None:
+        def reducefn(texts, agendaitem):
+            return reduce_texts(texts, agendaitem, callapi)
+
+    data_folder = create_data_folder()
+    state_file = get_digest_state_file(data_folder, meetingid)
+    state = load_digest_state(state_file)
+
+    # Group the summaries by agenda item
+    items = {}
+    for tdocnumber, tdoc in load_meeting_summaries(data_folder, meetingid).items():
+        items.setdefault(tdoc['agenda_item'], {})[tdocnumber] = tdoc['summary']
+
+    new_items = {}
+    used_nodes = {}
+    recomputed = []
+    errors = {}
+    for agenda_item in sorted(items):
+        tdocs = items[agenda_item]
+        tdoc_numbers = sorted(tdocs)
+        fingerprint = get_text_hash(*[tdocnumber + get_text_hash(tdocs[tdocnumber]) for tdocnumber in tdoc_numbers])
+
+        previous = state['items'].get(agenda_item)
+        if previous is not None and previous['fingerprint'] == fingerprint:
+            # No new or changed TDocs, keep the digest and its reduce steps
+            new_items[agenda_item] = previous
+            for node_hash in previous.get('nodes', []):
+                if node_hash in state['nodes']:
+                    used_nodes[node_hash] = state['nodes'][node_hash]
+            continue
+
+        item_nodes = {}
+        digest, steps, err = reduce_hierarchically(tdocs, agenda_item, state['nodes'], item_nodes, reducefn, groupsize)
+        if err != '':
+            errors[agenda_item] = err
+            if previous is not None:
+                new_items[agenda_item] = previous
+                for node_hash in previous.get('nodes', []):
+                    if node_hash in state['nodes']:
+                        used_nodes[node_hash] = state['nodes'][node_hash]
+            continue
+
+        logging.info(f"Agenda item {agenda_item} digest updated: {len(tdoc_numbers)} tdocs, {steps} reduce steps")
+        used_nodes.update(item_nodes)
+        new_items[agenda_item] = {'fingerprint': fingerprint, 'tdocs': tdoc_numbers, 'digest': digest,
+                                  'nodes': list(item_nodes)}
+        recomputed.append(agenda_item)
+
+    # Reduce steps not used by any agenda item are dropped
+    save_digest_state(state_file, {'items': new_items, 'nodes': used_nodes})
+
+    digests = {agenda_item: item['digest'] for agenda_item, item in new_items.items()}
+    return digests, recomputed, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest meeting digest grouped by agenda item')
+    parser.add_argument('meetingid')
+    parser.add_argument('--callapi', action='store_true', help='call the gpt-4o API for the reduce steps')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    meeting_digests, updated_items, digest_errors = build_meeting_digest(args.meetingid, callapi=args.callapi)
+    for item in sorted(meeting_digests):
+        print(f"Agenda item {item}{' (updated)' if item in updated_items else ''}")
+        print(meeting_digests[item])
+        print()
+    for item, digest_err in digest_errors.items():
+        print(f"Agenda item {item}: {digest_err}")
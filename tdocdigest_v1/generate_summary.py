@@ -1,13 +1,83 @@
 """
 This file handles summary generation for the TDoc Digest
 """
+import asyncio
 import logging
 import requests
+import httpx
 import zipfile
 import io
 import os
-from openai import OpenAI
 import docx2txt
+from manage_common import format_openai_error
+from manage_apikeys import acquire_api_key, release_api_key, get_openai_client, get_async_openai_client
+from extract_proposals import extract_items, format_extracted_items, SUMMARY_HEADER_LENGTH
+
+# RAN1 folder in 3GPP site (TDOCDIGEST_TDOC_URL is used for a local server, for example in load tests)
+TDOC_BASE_URL = "https://www.3gpp.org/ftp/TSG_RAN/WG1_RL1"
+
+
+def get_tdoc_url(meetingid, tdocnumber):
+    """
+    Returns the url of the zip file of the tdoc in 3GPP site
+    :param meetingid (str): the meeting id of the tdoc
+    :param tdocnumber (str): the tdoc number
+    :return (str): url of the zip file
+    """
+    tdoc_base_url = os.getenv("TDOCDIGEST_TDOC_URL", TDOC_BASE_URL)
+    return tdoc_base_url + "/TSGR1_" + meetingid + "/Docs/" + tdocnumber + ".zip"
+
+
+def extract_tdoc_zip(content, tdocnumber, workingfolder):
+    """
+    Extracts the zip file of the tdoc into the workingfolder and finds the tdoc (.docx file)
+    The zip file may contain more than one file. Search through all extracted files to locate the tdoc
+    Used by download_and_extract_tdoc and download_and_extract_tdoc_async (in an executor)
+    :param content (bytes): content of the zip file
+    :param tdocnumber (str): the tdoc number
+    :param workingfolder (str): the folder where the tdoc will be extracted
+    :return tdocfile (str): the extracted tdoc file name and empty string if no tdoc file was found
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    err = ''
+
+    # Create a ZipFile object from the content
+    with zipfile.ZipFile(io.BytesIO(content)) as zip_ref:
+        # Extract all contents
+        zip_ref.extractall(workingfolder)
+        # Get the list of files in the ZIP
+        files = zip_ref.namelist()
+
+    # check if the provided tdoc number is a contribution or not
+    # There are documents in the folder which are not TDoc.
+    # They may be agreements, wayforwards etc
+    # 3GPP TDoc name starts the docx file name with the tdoc number
+    logging.debug(f'processing files {files}')
+    tdocfile = ''
+    for filename in files:
+        if filename.lower().startswith((tdocnumber.lower())):
+
+            logging.debug(f'Found a file name begins with tdoc number: {filename}')
+
+            if filename.lower().endswith(('.docx')):
+                tdocfile = filename
+                err = ''
+                logging.debug(f'File found is a docx file: {tdocfile}')
+                break
+            else:
+                logging.info(f'Not Found: {filename.lower()}, {tdocnumber.lower()}')
+                err = "File must be a Word document (.docx) format"
+
+    # After iterating through all files, a docx file starting with tdoc number is not found
+    if tdocfile == '':
+        logging.warning(
+            f'After iterating through all files, a docx file starting with tdoc number is not found: {filename.lower()}, {tdocnumber.lower()}')
+        if err == '':
+            err = f"After iterating through all files, a docx file starting with tdoc number is not found"
+            logging.error(err)
+
+    # return the file name
+    return tdocfile, err
 
 
 def download_and_extract_tdoc(meetingid, tdocnumber, workingfolder):
@@ -25,7 +95,7 @@ def download_and_extract_tdoc(meetingid, tdocnumber, workingfolder):
     logging.debug(f'Download & extract: meeting#{meetingid},TDoc#{tdocnumber},working folder:{workingfolder}')
 
     # The url for the zip file in 3GPP site
-    url_tdoc_zip_file = "https://www.3gpp.org/ftp/TSG_RAN/WG1_RL1/TSGR1_" + meetingid + "/Docs/" + tdocnumber + ".zip"
+    url_tdoc_zip_file = get_tdoc_url(meetingid, tdocnumber)
 
     err = ''
 
@@ -34,43 +104,8 @@ def download_and_extract_tdoc(meetingid, tdocnumber, workingfolder):
         response = requests.get(url_tdoc_zip_file)
         response.raise_for_status()  # Raise an exception for bad status codes
 
-        # Create a ZipFile object from the content
-        with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
-            # Extract all contents
-            zip_ref.extractall(workingfolder)
-            # Get the list of files in the ZIP
-            files = zip_ref.namelist()
-
-        # check if the provided tdoc number is a contribution or not
-        # There are documents in the folder which are not TDoc.
-        # They may be agreements, wayforwards etc
-        # 3GPP TDoc name starts the docx file name with the tdoc number
-        logging.debug(f'processing files {files}')
-        tdocfile = ''
-        for filename in files:
-            if filename.lower().startswith((tdocnumber.lower())):
-
-                logging.debug(f'Found a file name begins with tdoc number: {filename}')
-
-                if filename.lower().endswith(('.docx')):
-                    tdocfile = filename
-                    err = ''
-                    logging.debug(f'File found is a docx file: {tdocfile}')
-                    break
-                else:
-                    logging.info(f'Not Found: {filename.lower()}, {tdocnumber.lower()}')
-                    err = "File must be a Word document (.docx) format"
-
-        # After iterating through all files, a docx file starting with tdoc number is not found
-        if tdocfile == '':
-            logging.warning(
-                f'After iterating through all files, a docx file starting with tdoc number is not found: {filename.lower()}, {tdocnumber.lower()}')
-            if err == '':
-                err = f"After iterating through all files, a docx file starting with tdoc number is not found"
-                logging.error(err)
-
-        # return the file name
-        return tdocfile, err
+        # Extract the zip file and find the tdoc
+        return extract_tdoc_zip(response.content, tdocnumber, workingfolder)
 
     except requests.exceptions.RequestException as e:
         err = f"Check if the meeting id and tdoc number are correct. Attempting to download the file: {e}"
@@ -85,22 +120,65 @@ def download_and_extract_tdoc(meetingid, tdocnumber, workingfolder):
     return [], err
 
 
-def get_tdoc_content(filepath, userkey, callapi):
+async def download_and_extract_tdoc_async(meetingid, tdocnumber, workingfolder, client=None):
     """
-    Generate text summary. If callapi is
+    Same as download_and_extract_tdoc with an async HTTP client (the zip file is extracted in an executor)
+    :param meetingid (str): the meeting id of the tdoc
+    :param tdocnumber (str): the tdoc number
+    :param workingfolder (str): the folder where the tdoc will be extracted
+    :param client (httpx.AsyncClient): client shared by the requests (None to use a client for this download)
+    :return tdocfile (str): the extracted tdoc file name and empty string if no tdoc file was found
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    logging.debug(f'Download & extract: meeting#{meetingid},TDoc#{tdocnumber},working folder:{workingfolder}')
+
+    url_tdoc_zip_file = get_tdoc_url(meetingid, tdocnumber)
+
+    err = ''
+
+    try:
+        # No timeout and redirects followed, as requests.get
+        if client is None:
+            async with httpx.AsyncClient(timeout=None, follow_redirects=True) as download_client:
+                response = await download_client.get(url_tdoc_zip_file)
+        else:
+            response = await client.get(url_tdoc_zip_file)
+        response.raise_for_status()
+
+        return await asyncio.get_running_loop().run_in_executor(None, extract_tdoc_zip, response.content,
+                                                                tdocnumber, workingfolder)
+
+    except httpx.HTTPStatusError as e:
+        # Same message as requests (raise_for_status)
+        status = f"{e.response.status_code} {'Client' if e.response.status_code < 500 else 'Server'} Error: " \
+                 f"{e.response.reason_phrase} for url: {e.response.url}"
+        err = f"Check if the meeting id and tdoc number are correct. Attempting to download the file: {status}"
+        logging.error(err)
+    except httpx.HTTPError as e:
+        err = f"Check if the meeting id and tdoc number are correct. Attempting to download the file: {e}"
+        logging.error(err)
+    except zipfile.BadZipFile:
+        err = f"The file is not a zip file or is corrupted."
+        logging.error(err)
+    except Exception as e:
+        err = f"An unexpected error occurred: {e}"
+        logging.error(err)
+
+    return [], err
+
+
+def extract_tdoc_text(filepath):
+    """
+    Extract the text of the tdoc
     :param filepath (str): The full path to the file where input text is
-    :param userkey (str): key to call gpt-4o API (prompt)
-    :param callapi (bool): Whether to call the gpt-4o API (prompt) or not
-    :return summary_generated (str): the summary generated from gpt-4o API
     :return inputtext (str): the text of the file
     :return err (str): any errors during the processing
     """
     if not filepath.lower().endswith(('.docx')):
-        summary_generated = ''
         inputtext = ''
         err = "File must be a Word document (.docx) format"
         logging.error(err)
-        return summary_generated, inputtext, err
+        return inputtext, err
 
     try:
         # Extract text from the specified file
@@ -108,26 +186,76 @@ def get_tdoc_content(filepath, userkey, callapi):
         err = ''
         logging.debug('Text extracted successfully')
 
-        summary_generated, err = generate_text_summary(userkey, inputtext, callapi=callapi)
-        logging.debug(f'Text summary generated successfully, APIcall:{callapi}')
-
-        return summary_generated, inputtext, err
+        return inputtext, err
 
     except Exception as e:
-        summary_generated = ''
         inputtext = ''
         err = Exception(f"Error in extracting text from tdoc {str(e)}")
         logging.error(err)
+        return inputtext, err
+
+
+def get_tdoc_content(filepath, userkey, callapi, useextracteditems=False):
+    """
+    Generate text summary. If callapi is
+    :param filepath (str): The full path to the file where input text is
+    :param userkey (str): key to call gpt-4o API (prompt)
+    :param callapi (bool): Whether to call the gpt-4o API (prompt) or not
+    :param useextracteditems (bool): Whether to send the extracted proposals/observations instead of the full text
+    :return summary_generated (str): the summary generated from gpt-4o API
+    :return inputtext (str): the text of the file
+    :return err (str): any errors during the processing
+    """
+    inputtext, err = extract_tdoc_text(filepath)
+    if err != '':
+        summary_generated = ''
         return summary_generated, inputtext, err
 
+    # Proposals and observations extracted locally (sent instead of the full text)
+    extracted_items = extract_items(inputtext) if useextracteditems else None
+
+    summary_generated, err = generate_text_summary(userkey, inputtext, callapi=callapi,
+                                                   extracteditems=extracted_items)
+    logging.debug(f'Text summary generated successfully, APIcall:{callapi}')
+
+    return summary_generated, inputtext, err
+
+
+async def get_tdoc_content_async(filepath, userkey, callapi, useextracteditems=False):
+    """
+    Same as get_tdoc_content with the async OpenAI client (the .docx text is extracted in an executor)
+    :param filepath (str): The full path to the file where input text is
+    :param userkey (str): key to call gpt-4o API (prompt)
+    :param callapi (bool): Whether to call the gpt-4o API (prompt) or not
+    :param useextracteditems (bool): Whether to send the extracted proposals/observations instead of the full text
+    :return summary_generated (str): the summary generated from gpt-4o API
+    :return inputtext (str): the text of the file
+    :return err (str): any errors during the processing
+    """
+    loop = asyncio.get_running_loop()
+    inputtext, err = await loop.run_in_executor(None, extract_tdoc_text, filepath)
+    if err != '':
+        summary_generated = ''
+        return summary_generated, inputtext, err
+
+    # Proposals and observations extracted locally (sent instead of the full text)
+    extracted_items = await loop.run_in_executor(None, extract_items, inputtext) if useextracteditems else None
+
+    summary_generated, err = await generate_text_summary_async(userkey, inputtext, callapi=callapi,
+                                                               extracteditems=extracted_items)
+    logging.debug(f'Text summary generated successfully, APIcall:{callapi}')
+
+    return summary_generated, inputtext, err
+
 
 # Generate the summary from AI model
-def generate_text_summary(userkey, inputtext, callapi=False):
+def generate_text_summary(userkey, inputtext, callapi=False, extracteditems=None):
     """
     Generate text summary from input text.
     :param userkey (str): key to call gpt-4o API (prompt)
     :param inputtext (str): the text of the file (long original text)
     :param callapi (bool): Whether to call the gpt-4o API (prompt) or not:
+    :param extracteditems (list): proposals/observations from extract_items (None to send the full text)
     :return summary(str): The summary generated from gpt-4o API (prompt)
                           or first 2000 characters (for debugging purposes)
     :return err(str): any errors during the processing
@@ -140,19 +268,102 @@ def generate_text_summary(userkey, inputtext, callapi=False):
         logging.debug(f'Text summary generation first characters APIcall:{callapi}')
     # Generate the summary from AI model (LLM)
     else:
-        summary, err = generate_openai_summary(userkey, inputtext, temperature=0.1, model='gpt-4')
+        summary, err = generate_openai_summary(userkey, inputtext, temperature=0.1, model='gpt-4',
+                                               extracteditems=extracteditems)
+        logging.debug(f'Text summary generation openai APIcall:{callapi}')
+
+    return summary, err
+
+
+async def generate_text_summary_async(userkey, inputtext, callapi=False, extracteditems=None):
+    """
+    Same as generate_text_summary with the async OpenAI client
+    :param userkey (str): key to call gpt-4o API (prompt)
+    :param inputtext (str): the text of the file (long original text)
+    :param callapi (bool): Whether to call the gpt-4o API (prompt) or not:
+    :param extracteditems (list): proposals/observations from extract_items (None to send the full text)
+    :return summary(str): The summary generated from gpt-4o API (prompt)
+                          or first 2000 characters (for debugging purposes)
+    :return err(str): any errors during the processing
+    """
+    if not callapi:
+        summary = inputtext[0:2000]
+        err = ''
+        logging.debug(f'Text summary generation first characters APIcall:{callapi}')
+    else:
+        summary, err = await generate_openai_summary_async(userkey, inputtext, temperature=0.1, model='gpt-4',
+                                                           extracteditems=extracteditems)
         logging.debug(f'Text summary generation openai APIcall:{callapi}')
 
     return summary, err
 
 
-def generate_openai_summary(openAIkeyforUser, inputtext, temperature, model):
+def build_summary_messages(inputtext, extracteditems=None):
+    """
+    Build the chat messages used for generating the summary of a TDoc
+    The same messages are used for interactive requests and batch request files
+    If proposals/observations were extracted, only the document header and the extracted items are sent
+    :param inputtext (str): the text of the file (long original text)
+    :param extracteditems (list): proposals/observations from extract_items (None to send the full text)
+    :return messages (list): chat completion messages
+    """
+    if extracteditems:
+        messages = [
+            {"role": "system",
+             "content": "You are acting as a 3GPP Standard Delegate specializing in the RAN (Radio Access "
+                        "Network) Working Group 1 (WG1) for 5G/6G standardization. Generate a summary report from "
+                        "the text using terms common in 3GPP."},
+            {"role": "assistant",
+             "content": "Title of the summary is 'Document summary: Document title, document number. Include the "
+                        "document title, meeting number, agenda item, document number, title, source, "
+                        "document for, location information at the top of the summary."},
+            {"role": "system",
+             "content": "The proposals and observations of the document are listed after the document header "
+                        "with their explanation. Include all of them in the summary with a brief summary of the "
+                        "explanation."},
+            {"role": "user",
+             "content": inputtext[0:SUMMARY_HEADER_LENGTH] + "\n\nProposals and observations:\n\n"
+                        + format_extracted_items(extracteditems)}
+        ]
+        return messages
+
+    messages = [
+        {"role": "system",
+         "content": "You are acting as a 3GPP Standard Delegate specializing in the RAN (Radio Access "
+                    "Network) Working Group 1 (WG1) for 5G/6G standardization. Generate a summary report from "
+                    "the text using terms common in 3GPP."},
+        {"role": "assistant",
+         "content": "Title of the summary is 'Document summary: Document title, document number. Include the "
+                    "document title, meeting number, agenda item, document number, title, source, "
+                    "document for, location information at the top of the summary. Some documents list "
+                    "observations as items, for example, 'observation 1', 'observation 2' etc. If such "
+                    "observations exists in the document, include such observations in the summary. If "
+                    "explanations or reasons for such observation is described in the document, "
+                    "provide a brief summary."},
+        {"role": "system",
+         "content": "Some documents list proposals as items for example, 'proposal 1', 'proposal 2' etc. If "
+                    "such proposals exists in the document, include such proposals in the summary."},
+        {"role": "assistant",
+         "content": "An explanation for the proposal is usually provided. Include such explanation in the "
+                    "summary."},
+        {"role": "system",
+         "content": "Some documents list observations as items, for example, 'observation 1', 'observation 2' "
+                    "etc. If such observations exists in the document, include such observations in the "
+                    "summary."},
+        {"role": "user", "content": inputtext}
+    ]
+
+    return messages
+
+
+def generate_openai_summary(openAIkeyforUser, inputtext, temperature, model, extracteditems=None):
     """
     Generate text summary from input text using the gpt-4o API.
-    :param openAIkeyforUser (str): key to call gpt-4o API (prompt)
+    :param openAIkeyforUser (str): key to call gpt-4o API (prompt), replaced by a key of the key pool
     :param inputtext (str): the text of the file (long original text)
     :param temperature (float): the temperature of the gpt-4o API
     :param model (str): the gpt-4o model to generate summary from
+    :param extracteditems (list): proposals/observations from extract_items (None to send the full text)
     :return: summary(str): The summary generated from gpt-4o API (prompt)
     :return err(str): any errors during the processing
     """
@@ -161,43 +372,23 @@ def generate_openai_summary(openAIkeyforUser, inputtext, temperature, model):
 
     logging.info(f"Open AI API {model}, {temperature}")
 
-    # Get open AI key for the session
-    openAIkeyforUser = os.getenv("OPENAI_API_KEY")
+    # Get the least loaded open AI key of the key pool
+    openAIkeyforUser, err = acquire_api_key()
+    if err != '':
+        return summarygenerated, err
 
     # Generate summary using lower temperature, specific prompt and gpt-4o
-    client = OpenAI(api_key=openAIkeyforUser)
+    client = get_openai_client(openAIkeyforUser)
+    response_openai = None
 
     try:
         # Attempt to create a chat completion
         response_openai = client.chat.completions.create(
-            messages=[
-                {"role": "system",
-                 "content": "You are acting as a 3GPP Standard Delegate specializing in the RAN (Radio Access "
-                            "Network) Working Group 1 (WG1) for 5G/6G standardization. Generate a summary report from "
-                            "the text using terms common in 3GPP."},
-                {"role": "assistant",
-                 "content": "Title of the summary is 'Document summary: Document title, document number. Include the "
-                            "document title, meeting number, agenda item, document number, title, source, "
-                            "document for, location information at the top of the summary. Some documents list "
-                            "observations as items, for example, 'observation 1', 'observation 2' etc. If such "
-                            "observations exists in the document, include such observations in the summary. If "
-                            "explanations or reasons for such observation is described in the document, "
-                            "provide a brief summary."},
-                {"role": "system",
-                 "content": "Some documents list proposals as items for example, 'proposal 1', 'proposal 2' etc. If "
-                            "such proposals exists in the document, include such proposals in the summary."},
-                {"role": "assistant",
-                 "content": "An explanation for the proposal is usually provided. Include such explanation in the "
-                            "summary."},
-                {"role": "system",
-                 "content": "Some documents list observations as items, for example, 'observation 1', 'observation 2' "
-                            "etc. If such observations exists in the document, include such observations in the "
-                            "summary."},
-                {"role": "user", "content": inputtext}
-            ],
+            messages=build_summary_messages(inputtext, extracteditems),
             model=model,
             temperature=temperature,
         )
+        release_api_key(openAIkeyforUser, response_openai)
 
         # Retrieve and print the response if successful
         logging.info("OpenAI API call was successful.")
@@ -207,19 +398,53 @@ def generate_openai_summary(openAIkeyforUser, inputtext, temperature, model):
         return summarygenerated, err
 
     except Exception as e:
-        err = str(e)
-        logging.error(f"OpenAI API returned an error: {err}")
-        if "authentication" in err.lower():
-            err = f"Authentication failed. Check your API key. {err}"
-            logging.error(err)
-        if "rate limit" in err.lower():
-            err = f"Rate limit exceeded. Try again later. {err}"
-            logging.error(err)
-        if "invalid" in err.lower():
-            err = f"The request was invalid. Check your parameters. {err}"
-            logging.error(err)
-        else:
-            err = f"An unexpected OpenAI error occurred.{err}"
-            logging.error(err)
+        if response_openai is None:
+            # Throttling (429) puts the key in cool down
+            release_api_key(openAIkeyforUser, exception=e)
+        err = format_openai_error(e)
+
+        return summarygenerated, err
+
+
+async def generate_openai_summary_async(openAIkeyforUser, inputtext, temperature, model, extracteditems=None):
+    """
+    Same as generate_openai_summary with the async OpenAI client
+    :param openAIkeyforUser (str): key to call gpt-4o API (prompt), replaced by a key of the key pool
+    :param inputtext (str): the text of the file (long original text)
+    :param temperature (float): the temperature of the gpt-4o API
+    :param model (str): the gpt-4o model to generate summary from
+    :param extracteditems (list): proposals/observations from extract_items (None to send the full text)
+    :return: summary(str): The summary generated from gpt-4o API (prompt)
+    :return err(str): any errors during the processing
+    """
+    err = ''
+    summarygenerated = ''
+
+    logging.info(f"Open AI API {model}, {temperature}")
+
+    openAIkeyforUser, err = acquire_api_key()
+    if err != '':
+        return summarygenerated, err
+
+    client = get_async_openai_client(openAIkeyforUser)
+    response_openai = None
+
+    try:
+        response_openai = await client.chat.completions.create(
+            messages=build_summary_messages(inputtext, extracteditems),
+            model=model,
+            temperature=temperature,
+        )
+        release_api_key(openAIkeyforUser, response_openai)
+
+        logging.info("OpenAI API call was successful.")
+
+        summarygenerated = response_openai.choices[0].message.content
+        return summarygenerated, err
+
+    except Exception as e:
+        if response_openai is None:
+            release_api_key(openAIkeyforUser, exception=e)
+        err = format_openai_error(e)
 
         return summarygenerated, err
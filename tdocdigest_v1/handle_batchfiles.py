@@ -0,0 +1,408 @@
+"""
+This file handles batch (offline) request files for the TDoc Digest
+A set of TDocs is turned into a JSONL file of chat completion requests (OpenAI batch API format).
+The results are matched back to (meeting, TDoc) using the custom id and stored like interactive results.
+"""
+import os
+import json
+import logging
+import argparse
+from datetime import datetime
+from manage_common import get_file_path
+from generate_summary import build_summary_messages, download_and_extract_tdoc, get_tdoc_content
+from calculate_scores import build_score_messages, get_overall_score
+from handle_datafiles import create_data_folder, reserve_data_file, dump_data, load_latest_data
+from manage_workingfolder import create_working_folder, delete_working_folder
+from manage_tdoclist import filter_tdocs
+from manage_apikeys import acquire_api_key, release_api_key, get_openai_client
+
+# Kind of requests in a batch file (part of the custom id)
+BATCH_KIND_SUMMARY = 'summary'
+BATCH_KIND_SCORE = 'score'
+
+# Endpoint used for all batch requests
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+
+def create_batch_folder():
+    """
+    Creates a folder for batch request and result files
+    :return batch_folder (str): batch folder name
+    """
+    batch_folder = './batchdata'
+    try:
+        os.makedirs(batch_folder, exist_ok=True)
+    except OSError as e:
+        # Raise the error/exception
+        raise e
+
+    return batch_folder
+
+
+def create_custom_id(kind, meetingid, tdocnumber):
+    """
+    Creates the custom id of a batch request
+    Example: summary|118|R1-2405963
+    :param kind (str): kind of the request (summary or score)
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :return (str): custom id
+    """
+    return kind + '|' + meetingid + '|' + tdocnumber
+
+
+def parse_custom_id(customid):
+    """
+    Splits the custom id of a batch request into its parts
+    :param customid (str): custom id created by create_custom_id
+    :return kind (str), meetingid (str), tdocnumber (str): parts of the custom id
+    """
+    kind, meetingid, tdocnumber = customid.split('|', 2)
+    return kind, meetingid, tdocnumber
+
+
+def prepare_tdoc_texts(meetingid, tdocnumbers):
+    """
+    Downloads the specified tdocs and extracts the text of each of them
+    :param meetingid (str): meeting id
+    :param tdocnumbers (list): tdoc numbers
+    :return tdoctexts (dict): tdoc number -> text of the tdoc
+    :return errors (dict): tdoc number -> error string for the tdocs which could not be processed
+    """
+    tdoctexts = {}
+    errors = {}
+
+    working_folder = create_working_folder(meetingid)
+    for tdocnumber in tdocnumbers:
+        tdoc_file_name, err = download_and_extract_tdoc(meetingid, tdocnumber, working_folder)
+        if err != '':
+            errors[tdocnumber] = err
+            continue
+
+        # callapi = False, only the text of the tdoc is needed here
+        file_path = get_file_path(working_folder, tdoc_file_name)
+        _, tdoc_txt, err = get_tdoc_content(file_path, '', False)
+        if err != '':
+            errors[tdocnumber] = str(err)
+            continue
+
+        tdoctexts[tdocnumber] = tdoc_txt
+
+    delete_working_folder(working_folder)
+    logging.info(f"Batch texts prepared: {len(tdoctexts)} tdocs, {len(errors)} errors")
+
+    return tdoctexts, errors
+
+
+def create_batch_request_file(batchfolder, meetingid, tdoctexts, kind, model, temperature, tdocsummaries=None):
+    """
+    Creates a JSONL file of chat completion requests for the specified tdocs
+    The messages are the same as generate_openai_summary (kind summary) and calculate_semantic_score (kind score)
+    batch file format is batch_<kind>_<meetingid>_<timestamp>.jsonl
+    :param batchfolder (str): batch folder
+    :param meetingid (str): meeting id
+    :param tdoctexts (dict): tdoc number -> text of the tdoc
+    :param kind (str): BATCH_KIND_SUMMARY or BATCH_KIND_SCORE
+    :param model (str): openai model
+    :param temperature (float): temperature of the model
+    :param tdocsummaries (dict): tdoc number -> summary text (required for kind score)
+    :return requestfilenamefull (str): request file full path
+    :return count (int): number of requests written
+    """
+    time_stamp_format = '%Y%m%d_%H%M%S'
+    file_time_stamp = datetime.now().strftime(time_stamp_format)
+
+    requestfilename = 'batch_' + kind + '_' + meetingid + '_' + file_time_stamp + '.jsonl'
+    requestfilenamefull = get_file_path(batchfolder, requestfilename)
+
+    count = 0
+    with open(requestfilenamefull, 'w', encoding='utf-8') as file:
+        for tdocnumber, tdoc_txt in tdoctexts.items():
+            if kind == BATCH_KIND_SUMMARY:
+                messages = build_summary_messages(tdoc_txt)
+            elif kind == BATCH_KIND_SCORE:
+                # Score requests need the summary generated for the tdoc
+                if not tdocsummaries or tdocnumber not in tdocsummaries:
+                    logging.warning(f"No summary for {tdocnumber}, score request skipped")
+                    continue
+                messages = build_score_messages(tdocsummaries[tdocnumber], tdoc_txt)
+            else:
+                raise ValueError(f"Unknown batch request kind: {kind}")
+
+            request = {
+                "custom_id": create_custom_id(kind, meetingid, tdocnumber),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {"model": model, "messages": messages, "temperature": temperature},
+            }
+            file.write(json.dumps(request) + '\n')
+            count += 1
+
+    logging.info(f"Batch request file created {requestfilenamefull} with {count} requests")
+    return requestfilenamefull, count
+
+
+def submit_batch_file(requestfile):
+    """
+    Uploads the request file and creates a batch job in OpenAI
+    :param requestfile (str): request file full path
+    :return batchid (str): id of the batch job
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    batchid = ''
+    # Least loaded key of the key pool
+    apikey, err = acquire_api_key()
+    if err != '':
+        return batchid, err
+
+    batch = None
+    try:
+        client = get_openai_client(apikey)
+        with open(requestfile, 'rb') as file:
+            batch_input_file = client.files.create(file=file, purpose="batch")
+
+        batch = client.batches.create(input_file_id=batch_input_file.id,
+                                      endpoint=BATCH_ENDPOINT,
+                                      completion_window="24h")
+        release_api_key(apikey)
+        batchid = batch.id
+        logging.info(f"Batch job created {batchid} for {requestfile}")
+
+    except Exception as e:
+        if batch is None:
+            release_api_key(apikey, exception=e)
+        err = f"Batch submission failed: {e}"
+        logging.error(err)
+
+    return batchid, err
+
+
+def retrieve_batch_results(batchid, resultfile):
+    """
+    Downloads the results of a completed batch job into the result file
+    :param batchid (str): id of the batch job
+    :param resultfile (str): result file full path
+    :return err (str): error string (if any, including a batch job which is not completed) otherwise an empty string
+    """
+    # Least loaded key of the key pool
+    apikey, err = acquire_api_key()
+    if err != '':
+        return err
+
+    content = None
+    try:
+        client = get_openai_client(apikey)
+        batch = client.batches.retrieve(batchid)
+        if batch.status != 'completed':
+            release_api_key(apikey)
+            err = f"Batch job {batchid} is not completed, status: {batch.status}"
+            logging.info(err)
+            return err
+
+        content = client.files.content(batch.output_file_id)
+        release_api_key(apikey)
+        with open(resultfile, 'w', encoding='utf-8') as file:
+            file.write(content.text)
+        logging.info(f"Batch results {batchid} saved to {resultfile}")
+
+    except Exception as e:
+        if content is None:
+            release_api_key(apikey, exception=e)
+        err = f"Batch results could not be retrieved: {e}"
+        logging.error(err)
+
+    return err
+
+
+def run_local_batch(requestfile, resultfile, completionfn=None):
+    """
+    Local stand-in for the batch API: processes a request file and writes a result file in the same format
+    :param requestfile (str): request file full path
+    :param resultfile (str): result file full path
+    :param completionfn (callable): function body (dict) -> content (str). If None, the first 2000 characters
+                                    of the last message are returned (same as callapi = False)
+    :return count (int): number of requests processed
+    """
+    if completionfn is None:
+        def completionfn(body):
+            return body["messages"][-1]["content"][0:2000]
+
+    count = 0
+    with open(requestfile, 'r', encoding='utf-8') as infile, open(resultfile, 'w', encoding='utf-8') as outfile:
+        for line in infile:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            count += 1
+            result = {"id": f"batch_req_{count}", "custom_id": request["custom_id"], "response": None, "error": None}
+            try:
+                content = completionfn(request["body"])
+                result["response"] = {
+                    "status_code": 200,
+                    "request_id": f"local_{count}",
+                    "body": {
+                        "model": request["body"].get("model"),
+                        "choices": [{"index": 0,
+                                     "message": {"role": "assistant", "content": content},
+                                     "finish_reason": "stop"}],
+                    },
+                }
+            except Exception as e:
+                result["error"] = {"code": "local_error", "message": str(e)}
+            outfile.write(json.dumps(result) + '\n')
+
+    logging.info(f"Local batch processed {count} requests from {requestfile}")
+    return count
+
+
+def read_batch_results(resultfile):
+    """
+    Reads a result file and matches the results to (meeting, TDoc) using the custom id
+    :param resultfile (str): result file full path
+    :return results (dict): (meetingid, tdocnumber) -> {kind: (content, err)}
+    """
+    results = {}
+    with open(resultfile, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            kind, meetingid, tdocnumber = parse_custom_id(result["custom_id"])
+
+            content = ''
+            err = ''
+            response = result.get("response")
+            if result.get("error"):
+                err = f"Batch request failed: {result['error'].get('message', result['error'])}"
+            elif not response or response.get("status_code") != 200:
+                err = f"Batch request failed with status {response.get('status_code') if response else None}"
+            else:
+                content = response["body"]["choices"][0]["message"]["content"]
+
+            if err != '':
+                logging.error(f"{result['custom_id']}: {err}")
+            results.setdefault((meetingid, tdocnumber), {})[kind] = (content, err)
+
+    return results
+
+
+def ingest_batch_results(resultfiles):
+    """
+    Stores the batch results in data files the same way as interactive results
+    Summary and score results of the same tdoc (in one or more result files) are stored together
+    A kind without a result in the result files is taken from the latest data file of the tdoc
+    :param resultfiles (list): result file full paths
+    :return data_filenames (list): data files written
+    """
+    results = {}
+    for resultfile in resultfiles:
+        for key, kinds in read_batch_results(resultfile).items():
+            results.setdefault(key, {}).update(kinds)
+
+    time_stamp_format = '%Y%m%d_%H%M%S'
+    file_time_stamp = datetime.now().strftime(time_stamp_format)
+
+    data_folder = create_data_folder()
+    data_filenames = []
+    for (meetingid, tdocnumber), kinds in results.items():
+        # The summary and score results are usually ingested in separate runs,
+        # the kind missing here is carried forward from the latest data file of the tdoc
+        previous = load_latest_data(data_folder, meetingid, tdocnumber)
+
+        if BATCH_KIND_SUMMARY in kinds:
+            summary, err = kinds[BATCH_KIND_SUMMARY]
+        else:
+            summary, err = previous.get('tdoc_summary_txt', ''), previous.get('error', '')
+
+        overall_score = ''
+        if BATCH_KIND_SCORE in kinds:
+            rating_summary, err_score = kinds[BATCH_KIND_SCORE]
+            if rating_summary != '' and err_score == '':
+                overall_score = get_overall_score(rating_summary)
+        elif previous.get('score', 'Not calculated') != 'Not calculated':
+            overall_score = previous['score']
+
+        # A new data file (never the data file of another ingest or request written in the same second)
+        data_filename = reserve_data_file(data_folder, meetingid, tdocnumber, file_time_stamp)
+        session = {
+            'step': 2,
+            'meeting_id': meetingid,
+            'tdoc_number': tdocnumber,
+            'tdoc_summary_txt': summary,
+            'error': err,
+            'score': overall_score if overall_score != '' else 'Not calculated',
+            'log_path': '',
+            'data_filename': data_filename,
+        }
+        dump_data(data_filename, session, 'batch')
+        data_filenames.append(data_filename)
+
+    logging.info(f"Batch results ingested: {len(data_filenames)} data files")
+    return data_filenames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest batch request files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    prepare_parser = subparsers.add_parser('prepare', help='create a batch request file')
+    prepare_parser.add_argument('meetingid')
+    prepare_parser.add_argument('tdocnumbers', nargs='*')
+    prepare_parser.add_argument('--agenda', help='all tdocs of an agenda item in the TDoc list (sub items included)')
+    prepare_parser.add_argument('--source', help='all tdocs of a source in the TDoc list (Example: nokia)')
+    prepare_parser.add_argument('--kind', choices=[BATCH_KIND_SUMMARY, BATCH_KIND_SCORE], default=BATCH_KIND_SUMMARY)
+    prepare_parser.add_argument('--summaries', help='summary result file (required for kind score)')
+    prepare_parser.add_argument('--model', default='gpt-4')
+
+    submit_parser = subparsers.add_parser('submit', help='submit a batch request file')
+    submit_parser.add_argument('requestfile')
+
+    retrieve_parser = subparsers.add_parser('retrieve', help='download the results of a batch job')
+    retrieve_parser.add_argument('batchid')
+    retrieve_parser.add_argument('resultfile')
+
+    local_parser = subparsers.add_parser('local', help='process a batch request file locally')
+    local_parser.add_argument('requestfile')
+    local_parser.add_argument('resultfile')
+
+    ingest_parser = subparsers.add_parser('ingest', help='store batch results in data files')
+    ingest_parser.add_argument('resultfiles', nargs='+')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'prepare':
+        tdoc_numbers = args.tdocnumbers
+        if args.agenda or args.source:
+            # Selected from the TDoc list, only the selected tdocs are downloaded
+            listed_tdocs, list_err = filter_tdocs(args.meetingid, args.agenda, args.source)
+            if list_err != '':
+                print(list_err)
+            tdoc_numbers = tdoc_numbers + [tdoc['tdoc'] for tdoc in listed_tdocs if tdoc['tdoc'] not in tdoc_numbers]
+        if not tdoc_numbers:
+            parser.error('no tdocs (tdoc numbers, --agenda or --source)')
+        texts, text_errors = prepare_tdoc_texts(args.meetingid, tdoc_numbers)
+        summaries = None
+        if args.kind == BATCH_KIND_SCORE:
+            if not args.summaries:
+                parser.error('--summaries is required for kind score')
+            summaries = {tdoc: kinds[BATCH_KIND_SUMMARY][0]
+                         for (_, tdoc), kinds in read_batch_results(args.summaries).items()
+                         if BATCH_KIND_SUMMARY in kinds and kinds[BATCH_KIND_SUMMARY][1] == ''}
+        # Same temperatures as generate_text_summary and calculate_semantic_score
+        temperature = 0.1 if args.kind == BATCH_KIND_SUMMARY else 0.01
+        filename, _ = create_batch_request_file(create_batch_folder(), args.meetingid, texts, args.kind,
+                                                args.model, temperature, tdocsummaries=summaries)
+        print(filename)
+        for tdoc, text_err in text_errors.items():
+            print(f"{tdoc}: {text_err}")
+    elif args.command == 'submit':
+        batch_id, submit_err = submit_batch_file(args.requestfile)
+        print(batch_id or submit_err)
+    elif args.command == 'retrieve':
+        print(retrieve_batch_results(args.batchid, args.resultfile) or args.resultfile)
+    elif args.command == 'local':
+        print(run_local_batch(args.requestfile, args.resultfile))
+    elif args.command == 'ingest':
+        for filename in ingest_batch_results(args.resultfiles):
+            print(filename)
@@ -2,8 +2,9 @@
 This file handles data files for the TDoc Digest
 """
 import os
+import glob
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from manage_common import get_file_path
 import pickle
 
@@ -47,6 +48,28 @@ def create_data_file(datafolder, meetingid, tdocnumber, timestamp):
     return datafilenamefull
 
 
+def reserve_data_file(datafolder, meetingid, tdocnumber, timestamp):
+    """
+    Creates a new empty data file for a request (never a data file of another request)
+    If a request for the same tdoc created a data file in the same second, the timestamp is moved to the next second
+    :param datafolder (str): data folder
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param timestamp (str): timestamp of the request (%Y%m%d_%H%M%S)
+    :return datafilenamefull (str): data file full path
+    """
+    time_stamp_format = '%Y%m%d_%H%M%S'
+    while True:
+        datafilenamefull = create_data_file(datafolder, meetingid, tdocnumber, timestamp)
+        try:
+            # Exclusive creation, fails if the data file exists
+            with open(datafilenamefull, 'xb'):
+                return datafilenamefull
+        except FileExistsError:
+            timestamp = (datetime.strptime(timestamp, time_stamp_format) + timedelta(seconds=1)).strftime(
+                time_stamp_format)
+
+
 def dump_data(data_filename, session, identifier):
     try:
         logging.info(f"Dump data in pickle file {identifier}: {data_filename}")
@@ -64,3 +87,27 @@ def dump_data(data_filename, session, identifier):
             except pickle.PicklingError:
                 logging.info(f"Key '{key}' contains non-serializable value: {value}")
 
+
+def load_latest_data(datafolder, meetingid, tdocnumber):
+    """
+    Loads the latest data file of the tdoc (data_<meetingid>_<tdocnumber>_<timestamp>.pkl)
+    A data file reserved by reserve_data_file but not written yet is skipped (the previous data file is loaded)
+    :param datafolder (str): data folder
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :return session_data (dict): session data of the latest data file, empty if there is no data file
+    """
+    prefix = 'data_' + meetingid + '_' + tdocnumber + '_'
+    # Time stamp format %Y%m%d_%H%M%S (15 characters), so R1-2400010 does not match R1-24000101
+    data_filenames = sorted(data_filename for data_filename in glob.glob(get_file_path(datafolder, prefix + '*.pkl'))
+                            if len(os.path.basename(data_filename)) == len(prefix) + 15 + len('.pkl'))
+    for data_filename in reversed(data_filenames):
+        try:
+            if os.path.getsize(data_filename) == 0:
+                continue
+            with open(data_filename, 'rb') as file:
+                return pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logging.error(f"Error loading data file {data_filename}: {e}")
+
+    return {}
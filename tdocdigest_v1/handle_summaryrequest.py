@@ -0,0 +1,230 @@
+"""
+This file handles a summary request (meeting id, TDoc number) for the TDoc Digest
+The stages are download, text extraction, summary, score and data dump. Each stage except the data dump saves a
+checkpoint, so a retry of the same request resumes from the last completed stage. The data dump is written to a new
+data file for each request (the user score of the request is saved in it).
+"""
+import os
+import logging
+
+from manage_logfile import create_log_folder, create_log_file
+from handle_datafiles import reserve_data_file, create_data_folder, dump_data
+from manage_workingfolder import create_working_folder, delete_working_folder
+from manage_common import get_file_path, parse_agenda_item
+from manage_checkpoints import (get_input_hash, load_checkpoint, save_checkpoint, cleanup_checkpoints_periodically,
+                                STAGE_DOWNLOAD, STAGE_TEXT, STAGE_SUMMARY, STAGE_SCORE)
+from calculate_scores import calculate_semantic_score, calculate_semantic_score_samples, get_overall_score
+from generate_summary import download_and_extract_tdoc, extract_tdoc_text, generate_text_summary
+from extract_proposals import extract_items, update_item_index
+from manage_vectorindex import add_to_vector_index
+from manage_tdoclist import get_tdoc_metadata
+from user_authentication import authenticate_user
+
+
+def check_input_format(tdoc_number, meetingid=None):
+    # Check for errors in the user input
+    # With a meeting id, the TDoc number is also checked against the TDoc list of the meeting (if available)
+    error_tdoc = ''
+    if tdoc_number.strip().startswith('R1-'):
+        tdoc_number = tdoc_number.strip()
+        logging.info(f"Processing request {tdoc_number}")
+    elif tdoc_number.strip().lower().startswith('r1-'):
+        tdoc_number = tdoc_number.strip().replace('r1-', 'R1-')
+        logging.info(f"Processing request {tdoc_number}")
+    else:
+        tdoc_number = tdoc_number
+        error_tdoc = 'Wrong input TDoc number:' + tdoc_number + '. RAN1 TDoc has the format R1-<Numeric>.'
+        logging.error(error_tdoc)
+
+    if error_tdoc == '' and meetingid:
+        metadata, available = get_tdoc_metadata(meetingid, tdoc_number)
+        if available and metadata is None:
+            error_tdoc = 'TDoc ' + tdoc_number + ' is not in the TDoc list of meeting ' + meetingid + '.'
+            logging.error(error_tdoc)
+        elif metadata is not None:
+            logging.info(f"TDoc list: {metadata['title']}, {metadata['source']}, {metadata['agenda_item']}")
+
+    return tdoc_number, error_tdoc
+
+
+def get_tdoc_file(meetingid, tdocnumber, workingfolder):
+    """
+    Stage download: downloads the tdoc and extracts it into the working folder
+    If the stage was completed before, the .docx file is restored from the checkpoint
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param workingfolder (str): working folder
+    :return tdocfile (str): the extracted tdoc file name
+    :return docxcontent (bytes): content of the .docx file (used as input of the text stage)
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    download_hash = get_input_hash(meetingid, tdocnumber)
+    checkpoint = load_checkpoint(meetingid, tdocnumber, STAGE_DOWNLOAD, download_hash)
+    if checkpoint is not None:
+        tdoc_file_name, docx_content = checkpoint
+        file_path = get_file_path(workingfolder, tdoc_file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as file:
+            file.write(docx_content)
+        logging.info(f"Download stage restored from checkpoint: {tdoc_file_name}")
+        return tdoc_file_name, docx_content, ''
+
+    tdoc_file_name, err = download_and_extract_tdoc(meetingid, tdocnumber, workingfolder)
+    if err != '':
+        return tdoc_file_name, b'', err
+
+    with open(get_file_path(workingfolder, tdoc_file_name), 'rb') as file:
+        docx_content = file.read()
+    save_checkpoint(meetingid, tdocnumber, STAGE_DOWNLOAD, download_hash, (tdoc_file_name, docx_content))
+
+    return tdoc_file_name, docx_content, err
+
+
+def process_summary_request(meetingid, tdocnumber, session, callapi=False, useextracteditems=False, scoresamples=1):
+    """
+    Processes a summary request and saves the results in the session
+    Session keys set: log_path, error, tdoc_summary_txt, agenda_item, score, score_statistics, data_filename
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number (as entered by the user)
+    :param session (dict): session state (st.session_state or a dict)
+    :param callapi (bool): Whether to call the gpt-4o API (prompt) or not
+    :param useextracteditems (bool): Whether to send the extracted proposals/observations instead of the full text
+    :param scoresamples (int): number of ratings of the summary requested in the score API call
+    :return: None
+    """
+    # Create a folder to save the log files
+    log_folder = create_log_folder(meetingid)
+    log_path, filetimestamp = create_log_file(meetingid, tdocnumber, log_folder)
+    logging.info(f"Loging file created at:{log_path}")
+    logging.info(f"Summarization request: meeting:{meetingid},Tdoc:{tdocnumber}")
+
+    session["log_path"] = log_path
+
+    tdocnumber, error_tdoc = check_input_format(tdocnumber, meetingid)
+    if error_tdoc == '':
+        # TDoc number in the format used for the data files and indexes
+        session["tdoc_number"] = tdocnumber
+
+    # Create a folder to work (download/extract the tdoc)
+    # This folder is deleted at the end (the checkpoints are kept)
+    working_folder = create_working_folder(meetingid)
+    logging.info(f"Working folder created at: {working_folder}")
+
+    logging.info(f"Processing request: meeting id:{meetingid},TDoc#:{tdocnumber}")
+
+    # No errors found on the TDoc number
+    if error_tdoc == '':
+        # Download the tdoc from 3GPP FTP server, extract the zip file and find the word (.docx) file
+        # .docx file is saved in the working folder
+
+        tdoc_file_name, docx_content, err = get_tdoc_file(meetingid, tdocnumber, working_folder)
+        if err != '':
+            logging.error(f"Download/extract error: {err}")
+            session["error"] = err
+
+        else:
+            logging.info(f"Download success:{tdoc_file_name}")
+            # TDoc (.docx) file path
+            file_path = get_file_path(working_folder, tdoc_file_name)
+
+            # Get the user authenticated and get an API key
+            # Set the OPENAI_API_KEY environment variable
+            user_key = authenticate_user()
+
+            # Stage text: extract the text from the .docx file
+            text_hash = get_input_hash(docx_content)
+            tdoc_txt = load_checkpoint(meetingid, tdocnumber, STAGE_TEXT, text_hash)
+            err_summary_gen = ''
+            if tdoc_txt is None:
+                tdoc_txt, err_summary_gen = extract_tdoc_text(file_path)
+                if err_summary_gen == '':
+                    save_checkpoint(meetingid, tdocnumber, STAGE_TEXT, text_hash, tdoc_txt)
+
+            # Stage summary: generate the text summary
+            summary_hash = get_input_hash(text_hash, callapi, useextracteditems)
+            tdoc_summary_txt = ''
+            if err_summary_gen == '':
+                tdoc_summary_txt = load_checkpoint(meetingid, tdocnumber, STAGE_SUMMARY, summary_hash)
+                if tdoc_summary_txt is None:
+                    # Proposals and observations extracted locally (sent instead of the full text)
+                    extracted_items = extract_items(tdoc_txt) if useextracteditems else None
+                    tdoc_summary_txt, err_summary_gen = generate_text_summary(user_key, tdoc_txt, callapi=callapi,
+                                                                              extracteditems=extracted_items)
+                    if err_summary_gen == '':
+                        save_checkpoint(meetingid, tdocnumber, STAGE_SUMMARY, summary_hash, tdoc_summary_txt)
+
+            if err_summary_gen != '':
+                logging.error(f"error:', {err_summary_gen}")
+                session["error"] = err_summary_gen
+            else:
+                logging.info(f"Summary generated:'{err_summary_gen}")
+                session["tdoc_summary_txt"] = tdoc_summary_txt
+                # Agenda item from the TDoc header, used for grouping the meeting digest
+                session["agenda_item"] = parse_agenda_item(tdoc_txt)
+                # Index the proposals/observations of the TDoc for searching without API calls
+                update_item_index(meetingid, tdocnumber, tdoc_txt, session["agenda_item"])
+                # Embed the summary and the text for the related TDocs (an error here does not fail the request)
+                add_to_vector_index(meetingid, tdocnumber, tdoc_summary_txt, tdoc_txt)
+
+            # p_mean, r_mean, f1_mean = calculate_bert_score(tdoc_summary_txt, tdoc_txt)
+            # logging.info(f"BERTScore: Precision:{p_mean}, Recall: {r_mean}, F1 Score: {f1_mean}")
+
+            # Stage score: semantic score of the summary
+            score_hash = get_input_hash(summary_hash, tdoc_summary_txt, scoresamples)
+            if callapi:
+                logging.info(f"Semantic score from API")
+                rating_summary = load_checkpoint(meetingid, tdocnumber, STAGE_SCORE, score_hash)
+                err_score_cal = ''
+                if rating_summary is None:
+                    if scoresamples > 1:
+                        # Several ratings in one call, rating_summary is the statistics of each criterion
+                        rating_summary, err_score_cal = calculate_semantic_score_samples(
+                            tdoc_summary_txt, tdoc_txt, user_key, model='gpt-4', nsamples=scoresamples)
+                    else:
+                        rating_summary, err_score_cal = calculate_semantic_score(tdoc_summary_txt, tdoc_txt,
+                                                                                 user_key, model='gpt-4')
+                    if err_score_cal == '':
+                        save_checkpoint(meetingid, tdocnumber, STAGE_SCORE, score_hash, rating_summary)
+
+                # If score calculation is successful,show to the user
+                if err_score_cal == '':
+                    logging.info(f"Semantic score {rating_summary}")
+
+                    if scoresamples > 1:
+                        session["score_statistics"] = rating_summary
+                        overall_score = ''
+                        if 'overall' in rating_summary:
+                            overall_score = f"{rating_summary['overall']['mean']:.1f}/10 " \
+                                            f"(agreement {rating_summary['overall']['agreement']:.0%})"
+                    else:
+                        overall_score = get_overall_score(rating_summary)
+                    if overall_score != '':
+                        logging.info(f"Overall score: {overall_score}")
+                        session["score"] = overall_score
+                else:
+                    # This error is not set to the session as this error is not required to show to the user
+                    logging.error(f"Semantic score calculation error {err_score_cal}")
+            else:
+                session["score"] = 'Not calculated'
+
+            # Dump the results to a new data file (not checkpointed, the data file belongs to this request)
+            data_folder = create_data_folder()
+            data_filename = reserve_data_file(data_folder, meetingid, tdocnumber, filetimestamp)
+            logging.info(f"Data pickle file {data_filename}")
+
+            # Store data_filename in the session
+            session["data_filename"] = data_filename
+            logging.info(f"Data file name saved to session")
+
+            # Dump data to the data file using identifier 1
+            dump_data(data_filename, session, 1)
+            logging.info(f"Data dumped 1")
+
+        # Remove the working folder
+        delete_working_folder(working_folder)
+
+        # Delete the old checkpoints (of all requests)
+        cleanup_checkpoints_periodically()
+
+    else:
+        session["error"] = error_tdoc
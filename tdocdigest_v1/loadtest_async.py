@@ -0,0 +1,274 @@
+"""
+This file benchmarks the asyncio variants of the pipeline functions against local stubs
+N TDoc requests (download, text extraction, summary and score) are run at once in a single event loop with the
+async functions (download_and_extract_tdoc_async, get_tdoc_content_async, calculate_semantic_score_async), then
+with the sync functions in a thread pool. The stubs of loadtest_pipeline run in another process, so the threads
+counted are the threads of the pipeline only.
+Example: python loadtest_async.py --requests 500 --latency 0.2
+"""
+import time
+import queue
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+
+from manage_common import get_file_path
+from generate_summary import (download_and_extract_tdoc, download_and_extract_tdoc_async, get_tdoc_content,
+                              get_tdoc_content_async)
+from calculate_scores import calculate_semantic_score, calculate_semantic_score_async
+from loadtest_pipeline import start_stub_server, set_stub_environment, get_percentile, TDOC_MARKER
+
+
+def serve_stubs(latency, urls):
+    """
+    Runs the stub server (in a separate process)
+    :param latency (float): response delay in seconds
+    :param urls (multiprocessing.Queue): queue where the url of the server is put
+    :return: None
+    """
+    server = start_stub_server(latency)
+    urls.put(f'http://127.0.0.1:{server.server_address[1]}')
+    threading.Event().wait()
+
+
+def start_stub_process(latency):
+    """
+    Starts the stub server in a separate process and points the pipeline to it
+    :param latency (float): response delay in seconds
+    :return process (multiprocessing.Process): stub server process (call process.terminate() to stop it)
+    """
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_stubs, args=(latency, urls), daemon=True)
+    process.start()
+    try:
+        set_stub_environment(urls.get(timeout=30))
+    except queue.Empty:
+        process.terminate()
+        raise RuntimeError('Stub server not started')
+
+    return process
+
+
+def check_result(tdocnumber, summary, err):
+    """
+    Checks the result of a request
+    :param tdocnumber (str): tdoc number
+    :param summary (str): summary of the tdoc
+    :param err (str): error string (if any) otherwise an empty string
+    :return (str): error or mismatch, empty string if the result is correct
+    """
+    if err != '':
+        return str(err)
+    if f'{TDOC_MARKER} {tdocnumber}' not in summary:
+        return 'summary of another tdoc'
+
+    return ''
+
+
+async def run_async_request(meetingid, tdocnumber, folder, client, callapi, inflight):
+    """
+    Processes one TDoc request with the async functions
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param folder (str): folder where the working folder of the request is created
+    :param client (httpx.AsyncClient): client shared by the downloads
+    :param callapi (bool): Whether to call the (stub) OpenAI API or not
+    :param inflight (dict): requests in flight and their peak (updated by the request)
+    :return result (dict): tdoc number, latency and error
+    """
+    inflight['current'] += 1
+    inflight['peak'] = max(inflight['peak'], inflight['current'])
+    start_time = time.perf_counter()
+    working_folder = tempfile.mkdtemp(dir=folder)
+    summary = ''
+    try:
+        tdoc_file_name, err = await download_and_extract_tdoc_async(meetingid, tdocnumber, working_folder, client)
+        if err == '':
+            summary, tdoc_txt, err = await get_tdoc_content_async(get_file_path(working_folder, tdoc_file_name), '',
+                                                                  callapi)
+        if err == '' and callapi:
+            _, err = await calculate_semantic_score_async(summary, tdoc_txt, '', model='gpt-4')
+    except Exception as e:
+        err = f'{type(e).__name__}: {e}'
+    finally:
+        inflight['current'] -= 1
+        shutil.rmtree(working_folder, ignore_errors=True)
+
+    return {'tdoc_number': tdocnumber, 'latency': time.perf_counter() - start_time,
+            'error': check_result(tdocnumber, summary, err)}
+
+
+async def run_async_requests(meetingid, tdocnumbers, folder, callapi):
+    """
+    Runs all the TDoc requests at once in the event loop
+    :param meetingid (str): meeting id
+    :param tdocnumbers (list): tdoc number of each request
+    :param folder (str): folder where the working folders are created
+    :param callapi (bool): Whether to call the (stub) OpenAI API or not
+    :return results (list): result of each request (see run_async_request)
+    :return peakinflight (int): maximum number of requests in flight
+    :return peakthreads (int): maximum number of threads of the process
+    """
+    inflight = {'current': 0, 'peak': 0}
+    threads = {'peak': threading.active_count()}
+
+    async def count_threads():
+        while True:
+            threads['peak'] = max(threads['peak'], threading.active_count())
+            await asyncio.sleep(0.01)
+
+    thread_counter = asyncio.create_task(count_threads())
+    # No limit on the connections, all the downloads are in flight at once
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=None, follow_redirects=True, limits=limits) as client:
+        results = await asyncio.gather(*[run_async_request(meetingid, tdocnumber, folder, client, callapi, inflight)
+                                         for tdocnumber in tdocnumbers])
+    thread_counter.cancel()
+
+    return results, inflight['peak'], threads['peak']
+
+
+def run_sync_request(meetingid, tdocnumber, folder, callapi):
+    """
+    Processes one TDoc request with the sync functions
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param folder (str): folder where the working folder of the request is created
+    :param callapi (bool): Whether to call the (stub) OpenAI API or not
+    :return result (dict): tdoc number, latency and error
+    """
+    start_time = time.perf_counter()
+    working_folder = tempfile.mkdtemp(dir=folder)
+    summary = ''
+    try:
+        tdoc_file_name, err = download_and_extract_tdoc(meetingid, tdocnumber, working_folder)
+        if err == '':
+            summary, tdoc_txt, err = get_tdoc_content(get_file_path(working_folder, tdoc_file_name), '', callapi)
+        if err == '' and callapi:
+            _, err = calculate_semantic_score(summary, tdoc_txt, '', model='gpt-4')
+    except Exception as e:
+        err = f'{type(e).__name__}: {e}'
+    finally:
+        shutil.rmtree(working_folder, ignore_errors=True)
+
+    return {'tdoc_number': tdocnumber, 'latency': time.perf_counter() - start_time,
+            'error': check_result(tdocnumber, summary, err)}
+
+
+def run_thread_requests(meetingid, tdocnumbers, folder, callapi, workers):
+    """
+    Runs all the TDoc requests at once with the sync functions in a thread pool
+    :param meetingid (str): meeting id
+    :param tdocnumbers (list): tdoc number of each request
+    :param folder (str): folder where the working folders are created
+    :param callapi (bool): Whether to call the (stub) OpenAI API or not
+    :param workers (int): threads of the pool
+    :return results (list): result of each request (see run_sync_request)
+    :return peakthreads (int): maximum number of threads of the process (the thread counter is not included)
+    """
+    threads = {'peak': threading.active_count()}
+    done = threading.Event()
+
+    def count_threads():
+        while not done.wait(0.01):
+            threads['peak'] = max(threads['peak'], threading.active_count() - 1)
+
+    thread_counter = threading.Thread(target=count_threads, daemon=True)
+    thread_counter.start()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_sync_request, meetingid, tdocnumber, folder, callapi)
+                   for tdocnumber in tdocnumbers]
+        results = [future.result() for future in futures]
+    done.set()
+    thread_counter.join()
+
+    return results, threads['peak']
+
+
+def summarize_results(mode, results, duration, peakinflight, peakthreads):
+    """
+    Computes the report of a benchmark run
+    :param mode (str): 'async' or 'threads'
+    :param results (list): result of each request
+    :param duration (float): duration of the run in seconds
+    :param peakinflight (int): maximum number of requests in flight
+    :param peakthreads (int): maximum number of threads of the process
+    :return report (dict): throughput, latencies, errors, requests in flight and threads
+    """
+    latencies = [result['latency'] for result in results]
+    errors = [f"{result['tdoc_number']}: {result['error']}" for result in results if result['error']]
+    return {
+        'mode': mode,
+        'requests': len(results),
+        'duration': duration,
+        'throughput': len(results) / duration,
+        'p50': get_percentile(latencies, 50),
+        'p99': get_percentile(latencies, 99),
+        'errors': errors,
+        'peak_in_flight': peakinflight,
+        'peak_threads': peakthreads,
+    }
+
+
+def run_benchmark(requests=200, meetingid='118', latency=0.2, callapi=True, threadworkers=0):
+    """
+    Runs the requests with the async functions in one event loop, then with the sync functions in a thread pool
+    :param requests (int): number of TDoc requests (all started at once)
+    :param meetingid (str): meeting id
+    :param latency (float): response delay of the stubs in seconds
+    :param callapi (bool): Whether to call the (stub) OpenAI API or not
+    :param threadworkers (int): threads of the sync run (0 for one thread per request, None to skip the sync run)
+    :return reports (list): report of each run (see summarize_results)
+    """
+    tdoc_numbers = [f'R1-99{index:05d}' for index in range(requests)]
+
+    stub_process = start_stub_process(latency)
+    folder = tempfile.mkdtemp(prefix='tdocdigest_loadtest_async_')
+    reports = []
+    try:
+        start_time = time.perf_counter()
+        results, peak_in_flight, peak_threads = asyncio.run(run_async_requests(meetingid, tdoc_numbers, folder,
+                                                                               callapi))
+        reports.append(summarize_results('async', results, time.perf_counter() - start_time, peak_in_flight,
+                                         peak_threads))
+
+        if threadworkers is not None:
+            workers = threadworkers or requests
+            start_time = time.perf_counter()
+            results, peak_threads = run_thread_requests(meetingid, tdoc_numbers, folder, callapi, workers)
+            reports.append(summarize_results('threads', results, time.perf_counter() - start_time,
+                                             min(workers, requests), peak_threads))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        stub_process.terminate()
+
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest async pipeline benchmark with local stubs')
+    parser.add_argument('--requests', type=int, default=200, help='number of TDoc requests started at once')
+    parser.add_argument('--meetingid', default='118')
+    parser.add_argument('--latency', type=float, default=0.2, help='stub response delay in seconds')
+    parser.add_argument('--no-api', action='store_true', help='callapi = False (no summary/score calls)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='threads of the sync run (default one per request, -1 to skip the sync run)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    benchmark = run_benchmark(args.requests, args.meetingid, args.latency, not args.no_api,
+                              None if args.threads < 0 else args.threads)
+    for report in benchmark:
+        print(f"{report['mode']}: {report['requests']} requests, duration: {report['duration']:.2f}s, "
+              f"throughput: {report['throughput']:.1f} requests/s, "
+              f"latency p50: {report['p50']:.3f}s, p99: {report['p99']:.3f}s")
+        print(f"  peak in flight: {report['peak_in_flight']}, peak threads: {report['peak_threads']}, "
+              f"errors: {len(report['errors'])}")
+        for error in report['errors'][0:3]:
+            print(f"    {error}")
@@ -0,0 +1,335 @@
+"""
+This file runs a load test of the TDoc Digest pipeline (process_summary_request)
+N concurrent sessions are driven through the pipeline against local stubs of the 3GPP site and the OpenAI API.
+The report shows throughput, p50/p99 latency and interference between requests
+(errors such as missing files, log lines written to the log file of another request, wrong or corrupted data dumps).
+Example: python loadtest_pipeline.py --sessions 50 --latency 0.2
+"""
+import os
+import io
+import json
+import time
+import pickle
+import shutil
+import zipfile
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from handle_summaryrequest import process_summary_request
+from manage_apikeys import get_key_usage
+
+# Number of API keys in the key pool (the stub accepts any key)
+LOADTEST_API_KEYS = 4
+
+# Text in each stub TDoc used to find which request a log line or a data file belongs to
+TDOC_MARKER = 'LOADTEST-MARKER'
+
+# Minimal .docx parts (enough for docx2txt)
+DOCX_CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                      '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                      '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                      '<Default Extension="xml" ContentType="application/xml"/>'
+                      '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-'
+                      'officedocument.wordprocessingml.document.main+xml"/></Types>')
+DOCX_RELS = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+             '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+             '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+             'officeDocument" Target="word/document.xml"/></Relationships>')
+
+
+def make_docx(paragraphs):
+    """
+    Creates a minimal .docx file
+    :param paragraphs (list): paragraph texts
+    :return (bytes): content of the .docx file
+    """
+    body = ''.join(f'<w:p><w:r><w:t xml:space="preserve">{paragraph}</w:t></w:r></w:p>' for paragraph in paragraphs)
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f'<w:body>{body}</w:body></w:document>')
+
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+        docx.writestr('_rels/.rels', DOCX_RELS)
+        docx.writestr('word/document.xml', document)
+
+    return content.getvalue()
+
+
+def make_tdoc_zip(meetingid, tdocnumber):
+    """
+    Creates the zip file of a stub TDoc (as published in the 3GPP site)
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :return (bytes): content of the zip file
+    """
+    paragraphs = [f'3GPP TSG RAN WG1 #{meetingid}', f'{TDOC_MARKER} {tdocnumber}', 'Agenda Item: 9.1.1',
+                  f'Title: Load test contribution {tdocnumber}', 'Source: Load test', 'Document for: Discussion',
+                  'Introduction'] + [f'Discussion paragraph {index} of {tdocnumber}.' for index in range(200)]
+    paragraphs += [f'Proposal 1: Support load testing of {tdocnumber}.',
+                   f'Observation 1: {tdocnumber} was processed concurrently.']
+
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as tdoc_zip:
+        tdoc_zip.writestr(tdocnumber + '.docx', make_docx(paragraphs))
+
+    return content.getvalue()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Stub of the 3GPP site (GET .../TSGR1_<meetingid>/Docs/<tdocnumber>.zip)
+    and the OpenAI API (POST .../chat/completions)
+    """
+    # Response delay in seconds (network and model latency)
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        parts = self.path.strip('/').split('/')
+        if len(parts) < 3 or not parts[-3].startswith('TSGR1_') or not parts[-1].endswith('.zip'):
+            self.send_error(404)
+            return
+
+        content = make_tdoc_zip(parts[-3][len('TSGR1_'):], parts[-1][:-len('.zip')])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        prompt = request['messages'][-1]['content']
+        if 'Generated Summary' in prompt:
+            content = 'Relevance: 8/10\nCoherence: 7/10\nCompleteness: 8/10\nConciseness: 9/10\nOverall: 8/10'
+        else:
+            # The summary keeps the marker line of the TDoc
+            content = 'Document summary\n' + prompt[0:500]
+
+        choices = [{'index': index, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}
+                   for index in range(request.get('n', 1))]
+        body = json.dumps({'id': 'chatcmpl-loadtest', 'object': 'chat.completion', 'created': int(time.time()),
+                           'model': request.get('model', ''), 'choices': choices,
+                           'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4,
+                                     'total_tokens': (len(prompt) + len(content)) // 4}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the stub quiet (the pipeline logs are checked)
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    HTTP server of the stubs (one thread per connection, a long listen queue for the connections opened at once)
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_stub_server(latency=0.0):
+    """
+    Starts the stub server in a background thread and points the pipeline to it
+    (TDOCDIGEST_TDOC_URL, OPENAI_BASE_URL and OPENAI_API_KEYS environment variables)
+    :param latency (float): response delay in seconds
+    :return server (ThreadingHTTPServer): the server (call server.shutdown() to stop it)
+    """
+    handler = type('LoadTestStubHandler', (StubHandler,), {'latency': latency})
+    server = StubServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    set_stub_environment(base_url)
+    logging.info(f"Stub server started at {base_url}")
+
+    return server
+
+
+def set_stub_environment(baseurl):
+    """
+    Points the pipeline to the stub server
+    :param baseurl (str): url of the stub server (Example: http://127.0.0.1:8000)
+    :return: None
+    """
+    os.environ['TDOCDIGEST_TDOC_URL'] = baseurl + '/ftp'
+    os.environ['OPENAI_BASE_URL'] = baseurl + '/v1'
+    os.environ['OPENAI_API_KEY'] = 'loadtest'
+    os.environ['OPENAI_API_KEYS'] = ','.join(f'loadtest-{index}' for index in range(LOADTEST_API_KEYS))
+
+
+def run_session(meetingid, tdocnumber, callapi):
+    """
+    Runs one simulated session through the pipeline
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param callapi (bool): Whether to call the (stub) OpenAI API or not
+    :return result (dict): meeting id, tdoc number, session, latency and exception (if any)
+    """
+    session = {'step': 1, 'tdoc_number': tdocnumber, 'meeting_id': meetingid, 'tdoc_summary_txt': '',
+               'error': '', 'score': '', 'log_path': ''}
+    exception = ''
+    start_time = time.perf_counter()
+    try:
+        process_summary_request(meetingid, tdocnumber, session, callapi)
+    except Exception as e:
+        exception = f'{type(e).__name__}: {e}'
+
+    return {'meeting_id': meetingid, 'tdoc_number': tdocnumber, 'session': session,
+            'latency': time.perf_counter() - start_time, 'exception': exception}
+
+
+def check_session(result, tdocnumbers, datafileowners):
+    """
+    Finds the interference of other requests in the result of a session
+    :param result (dict): result from run_session
+    :param tdocnumbers (set): tdoc numbers of all sessions of the load test
+    :param datafileowners (dict): data file name -> number of sessions which used it
+    :return issues (list): (issue type, description)
+    """
+    issues = []
+    session = result['session']
+    tdocnumber = result['tdoc_number']
+    other_tdocs = tdocnumbers - {tdocnumber}
+
+    if result['exception']:
+        issues.append(('exception', result['exception']))
+    if session.get('error'):
+        issues.append(('request error', str(session['error'])[0:200]))
+
+    # Log destination: the log file of the request must contain its own lines and only its own lines
+    log_path = session.get('log_path', '')
+    if not log_path or not os.path.exists(log_path):
+        issues.append(('missing log file', log_path))
+    else:
+        with open(log_path, 'r', encoding='utf-8', errors='replace') as file:
+            log_text = file.read()
+        if f'Tdoc:{tdocnumber}' not in log_text:
+            issues.append(('log written elsewhere', f'{log_path} has no lines of {tdocnumber}'))
+        foreign = sorted(tdoc for tdoc in other_tdocs if f'{tdoc},' in log_text or f'{tdoc}:' in log_text)
+        if foreign:
+            issues.append(('wrong log destination', f'{log_path} has lines of {len(foreign)} other requests'))
+
+    # Data dump: the data file must be readable and contain the results of this request
+    data_filename = session.get('data_filename', '')
+    if not session.get('error'):
+        if not data_filename or not os.path.exists(data_filename):
+            issues.append(('missing data file', data_filename))
+        else:
+            if datafileowners.get(data_filename, 0) > 1:
+                issues.append(('shared data file', f'{data_filename} used by {datafileowners[data_filename]} sessions'))
+            try:
+                with open(data_filename, 'rb') as file:
+                    data = pickle.load(file)
+                if data.get('tdoc_number') != tdocnumber or \
+                        f'{TDOC_MARKER} {tdocnumber}' not in data.get('tdoc_summary_txt', ''):
+                    issues.append(('wrong data dump', f'{data_filename} has data of {data.get("tdoc_number")}'))
+            except Exception as e:
+                issues.append(('corrupted data dump', f'{data_filename}: {type(e).__name__}: {e}'))
+
+    return issues
+
+
+def get_percentile(values, percent):
+    """
+    Returns the percentile (nearest rank) of the values
+    :param values (list): values
+    :param percent (float): percentile (0-100)
+    :return (float): percentile value
+    """
+    ordered = sorted(values)
+    rank = max(1, int(round(percent / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_load_test(sessions=20, tdocs=0, meetingid='118', latency=0.0, callapi=True):
+    """
+    Runs the load test in a temporary folder (log, working and data folders are relative to the current folder)
+    :param sessions (int): number of concurrent sessions
+    :param tdocs (int): number of distinct tdocs (0 for one tdoc per session)
+    :param meetingid (str): meeting id of all sessions (they share ./download_<meetingid>)
+    :param latency (float): response delay of the stubs in seconds
+    :param callapi (bool): Whether to call the (stub) OpenAI API or not
+    :return report (dict): throughput, latencies and issues
+    """
+    tdocs = tdocs or sessions
+    tdoc_numbers = [f'R1-99{index:05d}' for index in range(tdocs)]
+
+    server = start_stub_server(latency)
+    current_folder = os.getcwd()
+    test_folder = tempfile.mkdtemp(prefix='tdocdigest_loadtest_')
+    os.chdir(test_folder)
+    try:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            futures = [executor.submit(run_session, meetingid, tdoc_numbers[index % tdocs], callapi)
+                       for index in range(sessions)]
+            results = [future.result() for future in futures]
+        duration = time.perf_counter() - start_time
+
+        data_file_owners = {}
+        for result in results:
+            data_filename = result['session'].get('data_filename', '')
+            if data_filename:
+                data_file_owners[data_filename] = data_file_owners.get(data_filename, 0) + 1
+
+        issues = {}
+        failed_sessions = 0
+        for result in results:
+            session_issues = check_session(result, set(tdoc_numbers), data_file_owners)
+            failed_sessions += 1 if session_issues else 0
+            for issue_type, description in session_issues:
+                issues.setdefault(issue_type, []).append(f"{result['tdoc_number']}: {description}")
+    finally:
+        os.chdir(current_folder)
+        shutil.rmtree(test_folder, ignore_errors=True)
+        server.shutdown()
+
+    latencies = [result['latency'] for result in results]
+    return {
+        'sessions': sessions,
+        'duration': duration,
+        'throughput': sessions / duration,
+        'p50': get_percentile(latencies, 50),
+        'p99': get_percentile(latencies, 99),
+        'failed_sessions': failed_sessions,
+        'issues': issues,
+        'key_usage': get_key_usage(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest pipeline load test with local stubs')
+    parser.add_argument('--sessions', type=int, default=20, help='number of concurrent sessions')
+    parser.add_argument('--tdocs', type=int, default=0, help='number of distinct tdocs (default one per session)')
+    parser.add_argument('--meetingid', default='118')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response delay in seconds')
+    parser.add_argument('--no-api', action='store_true', help='callapi = False (no summary/score calls)')
+    args = parser.parse_args()
+
+    load_test = run_load_test(args.sessions, args.tdocs, args.meetingid, args.latency, not args.no_api)
+    print(f"Sessions: {load_test['sessions']}, duration: {load_test['duration']:.2f}s, "
+          f"throughput: {load_test['throughput']:.2f} requests/s")
+    print(f"Latency p50: {load_test['p50']:.3f}s, p99: {load_test['p99']:.3f}s")
+    print(f"Sessions with interference: {load_test['failed_sessions']}/{load_test['sessions']}")
+    for issue_name, descriptions in sorted(load_test['issues'].items()):
+        print(f"  {issue_name}: {len(descriptions)}")
+        for description in descriptions[0:3]:
+            print(f"    {description}")
+    for key_usage in load_test['key_usage']:
+        print(f"API key {key_usage['key']}: {key_usage['requests']} requests, "
+              f"{key_usage['prompt_tokens'] + key_usage['completion_tokens']} tokens")
@@ -2,16 +2,23 @@
 import streamlit as st
 import logging
 
-from manage_logfile import create_log_folder, create_log_file
-from handle_datafiles import create_data_file, create_data_folder, dump_data
-from manage_workingfolder import create_working_folder, delete_working_folder
-from manage_common import get_file_path
-from calculate_scores import calculate_semantic_score
-from generate_summary import get_tdoc_content, download_and_extract_tdoc
-from user_authentication import authenticate_user
+from handle_datafiles import dump_data
+from handle_summaryrequest import process_summary_request
+from manage_profiling import should_profile, profile_request
+from manage_vectorindex import query_related_tdocs
+from manage_diskquota import start_janitor
+from manage_apikeys import get_key_usage
+from user_authentication import is_admin
+
+# Background clean up of old logs, data files, checkpoints and orphan working folders
+start_janitor()
 
 st.header('**TDocDigest V3.0**')
 
+# Usage of each API key of the key pool (masked) for monitoring, admin deployment only (TDOCDIGEST_ADMIN=1)
+if is_admin():
+    st.sidebar.table(get_key_usage())
+
 # Initialize session state for storing inputs
 if "step" not in st.session_state:
     st.session_state['step'] = 1  # Step 1: Input tdoc_number and meeting id
@@ -23,23 +30,6 @@ if "step" not in st.session_state:
     st.session_state['log_path'] = ''
 
 
-def check_input_format(tdoc_number):
-    # Check for errors in the user input
-    error_tdoc = ''
-    if tdoc_number.strip().startswith('R1-'):
-        tdoc_number = tdoc_number.strip()
-        logging.info(f"Processing request {tdoc_number}")
-    elif tdoc_number.strip().lower().startswith('r1-'):
-        tdoc_number = tdoc_number.strip().replace('r1-', 'R1-')
-        logging.info(f"Processing request {tdoc_number}")
-    else:
-        tdoc_number = tdoc_number
-        error_tdoc = 'Wrong input TDoc number:' + tdoc_number + '. RAN1 TDoc has the format R1-<Numeric>.'
-        logging.error(error_tdoc)
-
-    return tdoc_number, error_tdoc
-
-
 def handle_summary_form_submit():
     meetingid = st.session_state.get("first_meeting_id", "").strip()
     tdocnumber = st.session_state.get("first_tdoc_number", "").strip()
@@ -54,102 +44,26 @@ def handle_summary_form_submit():
     st.session_state["meeting_id"] = meetingid
     st.session_state["tdoc_number"] = tdocnumber
 
-    # Create a folder to save the log files
-    log_folder = create_log_folder(meetingid)
-    log_path, filetimestamp = create_log_file(meetingid, tdocnumber, log_folder)
-    logging.info(f"Loging file created at:{log_path}")
-    logging.info(f"Summarization request: meeting:{meetingid},Tdoc:{tdocnumber}")
-
-    st.session_state["log_path"] = log_path
-
-    tdocnumber, error_tdoc = check_input_format(tdocnumber)
-
-    # Create a folder to work (download/extract the tdoc)
-    # This folder is deleted at the end
-    working_folder = create_working_folder(meetingid)
-    logging.info(f"Working folder created at: {working_folder}")
-
-    logging.info(f"Processing request: meeting id:{meetingid},TDoc#:{tdocnumber}")
-
-    # No errors found on the TDoc number
-    if error_tdoc == '':
-        # Download the tdoc from 3GPP FTP server, extract the zip file and find the word (.docx) file
-        # .docx file is saved in the working folder
-
-        tdoc_file_name, err = download_and_extract_tdoc(meetingid, tdocnumber, working_folder)
-        if err != '':
-            logging.error(f"Download/extract error: {err}")
-            st.session_state["error"] = err
-
-        else:
-            logging.info(f"Download success:{tdoc_file_name}")
-            # TDoc (.docx) file path
-            file_path = get_file_path(working_folder, tdoc_file_name)
-
-            # call_api is used for controlling the gpt-4o api call
-            # gpt-4o api calls bills based on the number of requests/tokens.
-            # When developer debugging other functional blocks, call_api = False does not call gpt-4o prompt.
-            # If call_api = False, only first 2000 characters of the extracted TDoc is returned
-            # If call_api = True, gpt-4o prompt is called (billed)
-            call_api = False  # True  #
-
-            # Get the user authenticated and get an API key
-            # Set the OPENAI_API_KEY environment variable
-            user_key = authenticate_user()
-
-            # Generate the text summary
-            tdoc_summary_txt, tdoc_txt, err_summary_gen = get_tdoc_content(file_path, user_key, call_api)
-            if err_summary_gen != '':
-                logging.error(f"error:', {err_summary_gen}")
-                st.session_state["error"] = err_summary_gen
-                # error_message = err_summary_gen
-            else:
-                logging.info(f"Summary generated:'{err_summary_gen}")
-                st.session_state["tdoc_summary_txt"] = tdoc_summary_txt
-                # text_summary = tdoc_summary_txt
-                # print('content:', tdoc_summary_txt)
-
-            # p_mean, r_mean, f1_mean = calculate_bert_score(tdoc_summary_txt, tdoc_txt)
-            # logging.info(f"BERTScore: Precision:{p_mean}, Recall: {r_mean}, F1 Score: {f1_mean}")
-
-            if call_api:
-                logging.info(f"Semantic score from API")
-                rating_summary, err_score_cal = calculate_semantic_score(tdoc_summary_txt, tdoc_txt, user_key,
-                                                                         model='gpt-4')
-
-                # If score calculation is successful,show to the user
-                if err_score_cal == '':
-                    logging.info(f"Semantic score {rating_summary}")
-
-                    # Split the string into lines and find the line that starts with "Overall"
-                    for line in rating_summary.splitlines():
-                        if line.startswith("Overall:"):
-                            overall_score = line.split(": ")[1]
-                            logging.info(f"Overall score: {overall_score}")
-                            st.session_state["score"] = overall_score
-                else:
-                    # This error is not set to the session as this error is not required to show to the user
-                    logging.error(f"Semantic score calculation error {err_score_cal}")
-            else:
-                st.session_state["score"] = 'Not calculated'
-
-            data_folder = create_data_folder()
-            data_filename = create_data_file(data_folder, meetingid, tdocnumber, filetimestamp)
-            logging.info(f"Data pickle file {data_filename}")
+    # call_api is used for controlling the gpt-4o api call
+    # gpt-4o api calls bills based on the number of requests/tokens.
+    # When developer debugging other functional blocks, call_api = False does not call gpt-4o prompt.
+    # If call_api = False, only first 2000 characters of the extracted TDoc is returned
+    # If call_api = True, gpt-4o prompt is called (billed)
+    call_api = False  # True  #
 
-            # Store data_filename in the session
-            st.session_state["data_filename"] = data_filename
-            logging.info(f"Data file name saved to session")
+    # use_extracted_items = True sends the proposals/observations extracted locally instead of the full text
+    use_extracted_items = False
 
-            # Dump data to the data file using identifier 1
-            dump_data(data_filename, st.session_state, 1)
-            logging.info(f"Data dumped 1")
+    # score_samples > 1 requests several ratings in one score API call and shows their mean and agreement
+    score_samples = 1
 
-        # Remove the working folder
-        delete_working_folder(working_folder)
+    # Profiling (cProfile/tracemalloc) is requested with ?profile=1 or sampled with TDOCDIGEST_PROFILE_PERCENT
+    profile = should_profile(st.query_params.get("profile") == "1")
 
-    else:
-        st.session_state["error"] = error_tdoc
+    # Download, summarize, score and dump the data (each stage resumes from its checkpoint on a retry)
+    with profile_request(st.session_state, enabled=profile):
+        process_summary_request(meetingid, tdocnumber, st.session_state, call_api, use_extracted_items,
+                                score_samples)
 
     st.session_state['step'] = 2
     logging.info(f"Changing session step {st.session_state['step']}")
@@ -206,6 +120,13 @@ if st.session_state.step == 2:
                     st.write(f" :blue[**Generated summary (Meeting ID:{st.session_state['meeting_id']}, TDoc Number:{st.session_state['tdoc_number']}):**]")
                     st.write(st.session_state["tdoc_summary_txt"])
                     st.write(f" :blue[**Semantic score:{st.session_state["score"]}**]")
+                    # Most similar TDocs of the same or earlier meetings (vector index)
+                    related_tdocs = query_related_tdocs(st.session_state['meeting_id'], st.session_state['tdoc_number'])
+                    if related_tdocs:
+                        st.write(f" :blue[**Related TDocs:**]")
+                        for related_tdoc in related_tdocs:
+                            st.write(f"Meeting {related_tdoc['meeting_id']}, {related_tdoc['tdoc_number']} "
+                                     f"(similarity {related_tdoc['score']:.2f})")
                     go_back_submit = st.form_submit_button("Go back", on_click=go_back)
                 with st.form("score_form"):
                     # st.text_input("My score:", key="user_score")
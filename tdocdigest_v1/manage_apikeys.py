@@ -0,0 +1,303 @@
+"""
+This file handles the pool of OpenAI API keys for the TDoc Digest
+The keys are read from OPENAI_API_KEYS (comma separated) or OPENAI_API_KEY. Each API call gets the least loaded
+healthy key (fewest errors in the last minute, then fewest calls in flight, then fewest tokens in the last minute)
+and releases it with the token usage of the call. A key throttled by the API (429) is not used during a cool down
+which doubles with each consecutive throttle. A key rejected by the API (401/403) is not used for
+AUTH_COOLDOWN_SECONDS and a key failing ERROR_THRESHOLD times in a row cools down like a throttled key.
+The usage of each key (masked) is returned by get_key_usage for monitoring.
+"""
+import os
+import time
+import asyncio
+import weakref
+import logging
+import threading
+from collections import deque
+from openai import OpenAI, AsyncOpenAI
+
+# Environment variables with the API keys (OPENAI_API_KEY is used when OPENAI_API_KEYS is not set)
+API_KEYS_ENV = 'OPENAI_API_KEYS'
+API_KEY_ENV = 'OPENAI_API_KEY'
+
+# Cool down of a throttled key: COOLDOWN_SECONDS, doubled for each consecutive throttle up to COOLDOWN_MAX_SECONDS
+COOLDOWN_SECONDS = 5.0
+COOLDOWN_MAX_SECONDS = 300.0
+
+# Cool down of a key rejected by the API (revoked or invalid key, no access to the model)
+AUTH_ERROR_STATUS_CODES = (401, 403)
+AUTH_COOLDOWN_SECONDS = 3600.0
+
+# Consecutive errors (other than throttling) before a key cools down
+ERROR_THRESHOLD = 3
+
+# Window of the request and token rates used for choosing the key
+USAGE_WINDOW_SECONDS = 60.0
+
+# Keys of the pool (reloaded when the environment variables change) and OpenAI clients of each key
+key_pool = {'source': None, 'keys': []}
+openai_clients = {}
+# Async clients of each event loop (dropped with the event loop)
+async_openai_clients = weakref.WeakKeyDictionary()
+key_pool_lock = threading.Lock()
+
+
+def create_key_state(apikey):
+    """
+    Creates the usage state of a key
+    :param apikey (str): API key
+    :return (dict): usage state
+    """
+    return {
+        'key': apikey,
+        'in_flight': 0,
+        'requests': 0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'throttled': 0,
+        'errors': 0,
+        'consecutive_throttles': 0,
+        'consecutive_errors': 0,
+        'cooldown_until': 0.0,
+        # (time, tokens) of the calls in the last USAGE_WINDOW_SECONDS
+        'recent': deque(),
+        # time of the errors in the last USAGE_WINDOW_SECONDS
+        'recent_errors': deque(),
+    }
+
+
+def load_api_keys():
+    """
+    Reads the API keys from the environment (the usage of the keys already in the pool is kept)
+    Called with key_pool_lock held
+    :return keys (list): usage state of each key
+    """
+    source = os.getenv(API_KEYS_ENV) or os.getenv(API_KEY_ENV) or ''
+    if source != key_pool['source']:
+        states = {state['key']: state for state in key_pool['keys']}
+        api_keys = [apikey.strip() for apikey in source.split(',') if apikey.strip()]
+        key_pool['keys'] = [states.get(apikey) or create_key_state(apikey) for apikey in dict.fromkeys(api_keys)]
+        key_pool['source'] = source
+        logging.info(f"API key pool: {len(key_pool['keys'])} keys")
+
+    return key_pool['keys']
+
+
+def get_api_keys():
+    """
+    Returns the API keys of the pool
+    :return (list): API keys (empty if OPENAI_API_KEYS and OPENAI_API_KEY are not set)
+    """
+    with key_pool_lock:
+        return [state['key'] for state in load_api_keys()]
+
+
+def mask_api_key(apikey):
+    """
+    Masks an API key for logs and monitoring (Example: sk-...Wxyz)
+    :param apikey (str): API key
+    :return (str): masked key
+    """
+    return apikey[:3] + '...' + apikey[-4:] if len(apikey) > 12 else '...' + apikey[-2:]
+
+
+def get_recent_usage(state, now):
+    """
+    Returns the calls and tokens of the key in the last USAGE_WINDOW_SECONDS
+    Called with key_pool_lock held
+    :param state (dict): usage state of the key
+    :param now (float): current time
+    :return requests (int), tokens (int), errors (int): calls, tokens and errors in the window
+    """
+    recent = state['recent']
+    while recent and recent[0][0] < now - USAGE_WINDOW_SECONDS:
+        recent.popleft()
+    recent_errors = state['recent_errors']
+    while recent_errors and recent_errors[0] < now - USAGE_WINDOW_SECONDS:
+        recent_errors.popleft()
+
+    return len(recent), sum(tokens for _, tokens in recent), len(recent_errors)
+
+
+def get_key_load(state, now):
+    """
+    Returns the load of the key used for choosing the key (the least loaded key is the smallest)
+    A failing key fails fast (no calls in flight, no tokens), so its errors are compared first
+    Called with key_pool_lock held
+    :param state (dict): usage state of the key
+    :param now (float): current time
+    :return (tuple): errors in the last USAGE_WINDOW_SECONDS, calls in flight, tokens and calls in the last
+                     USAGE_WINDOW_SECONDS
+    """
+    recent_requests, recent_tokens, recent_errors = get_recent_usage(state, now)
+    return recent_errors, state['in_flight'], recent_tokens, recent_requests
+
+
+def acquire_api_key():
+    """
+    Returns the least loaded healthy key of the pool (release it with release_api_key after the call)
+    If all the keys are cooling down, the key available first is returned
+    :return apikey (str): API key (empty string if no key is set)
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    with key_pool_lock:
+        keys = load_api_keys()
+        if not keys:
+            err = f"Error: {API_KEYS_ENV} or {API_KEY_ENV} environment variable is not set."
+            logging.error(err)
+            return '', err
+
+        now = time.time()
+        healthy = [state for state in keys if state['cooldown_until'] <= now]
+        if healthy:
+            state = min(healthy, key=lambda state: get_key_load(state, now))
+        else:
+            state = min(keys, key=lambda state: state['cooldown_until'])
+            logging.warning(f"All API keys are cooling down, using {mask_api_key(state['key'])}")
+
+        state['in_flight'] += 1
+        state['requests'] += 1
+
+        return state['key'], ''
+
+
+def is_rate_limit_error(exception):
+    """
+    Checks whether an exception raised by the OpenAI API is a throttling error (429)
+    :param exception (Exception): exception raised by the API call
+    :return (bool): True if the key was throttled
+    """
+    return getattr(exception, 'status_code', None) == 429 or 'rate limit' in str(exception).lower()
+
+
+def is_auth_error(exception):
+    """
+    Checks whether an exception raised by the OpenAI API is a rejected key (401/403)
+    :param exception (Exception): exception raised by the API call
+    :return (bool): True if the key is revoked, invalid or has no access
+    """
+    return getattr(exception, 'status_code', None) in AUTH_ERROR_STATUS_CODES
+
+
+def get_retry_after(exception):
+    """
+    Returns the Retry-After of a throttling error
+    :param exception (Exception): exception raised by the API call
+    :return (float): seconds, 0 if the response has no Retry-After
+    """
+    headers = getattr(getattr(exception, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def release_api_key(apikey, response=None, exception=None):
+    """
+    Releases a key returned by acquire_api_key and records the usage of the call
+    :param apikey (str): API key
+    :param response: response of the API call (None if the call failed), its usage is added to the key
+    :param exception (Exception): exception raised by the API call (None if successful)
+    :return: None
+    """
+    usage = getattr(response, 'usage', None)
+    tokens = (getattr(usage, 'prompt_tokens', 0) or 0, getattr(usage, 'completion_tokens', 0) or 0)
+
+    with key_pool_lock:
+        state = next((state for state in key_pool['keys'] if state['key'] == apikey), None)
+        if state is None:
+            # Removed from the environment during the call
+            return
+
+        now = time.time()
+        state['in_flight'] = max(0, state['in_flight'] - 1)
+        state['prompt_tokens'] += tokens[0]
+        state['completion_tokens'] += tokens[1]
+        state['recent'].append((now, sum(tokens)))
+
+        if exception is None:
+            state['consecutive_throttles'] = 0
+            state['consecutive_errors'] = 0
+        elif is_rate_limit_error(exception):
+            state['throttled'] += 1
+            state['consecutive_throttles'] += 1
+            cooldown = min(COOLDOWN_SECONDS * 2 ** (state['consecutive_throttles'] - 1), COOLDOWN_MAX_SECONDS)
+            state['cooldown_until'] = now + max(cooldown, get_retry_after(exception))
+            logging.warning(f"API key {mask_api_key(apikey)} throttled, cooling down for "
+                            f"{state['cooldown_until'] - now:.0f}s")
+        else:
+            state['errors'] += 1
+            state['consecutive_errors'] += 1
+            state['recent_errors'].append(now)
+            if is_auth_error(exception):
+                state['cooldown_until'] = now + AUTH_COOLDOWN_SECONDS
+                logging.error(f"API key {mask_api_key(apikey)} rejected by the API, not used for "
+                              f"{AUTH_COOLDOWN_SECONDS:.0f}s")
+            elif state['consecutive_errors'] >= ERROR_THRESHOLD:
+                cooldown = COOLDOWN_SECONDS * 2 ** (state['consecutive_errors'] - ERROR_THRESHOLD)
+                state['cooldown_until'] = now + min(cooldown, COOLDOWN_MAX_SECONDS)
+                logging.warning(f"API key {mask_api_key(apikey)} failed {state['consecutive_errors']} times, "
+                                f"cooling down for {state['cooldown_until'] - now:.0f}s")
+
+
+def get_openai_client(apikey):
+    """
+    Returns the OpenAI client of a key (the clients and their connections are reused between calls)
+    :param apikey (str): API key
+    :return (OpenAI): client
+    """
+    base_url = os.getenv("OPENAI_BASE_URL")
+    with key_pool_lock:
+        client = openai_clients.get((apikey, base_url))
+        if client is None:
+            client = OpenAI(api_key=apikey)
+            openai_clients[(apikey, base_url)] = client
+
+    return client
+
+
+def get_async_openai_client(apikey):
+    """
+    Returns the async OpenAI client of a key for the running event loop
+    (the connections of an async client can only be used in the event loop which opened them)
+    :param apikey (str): API key
+    :return (AsyncOpenAI): client
+    """
+    loop = asyncio.get_running_loop()
+    base_url = os.getenv("OPENAI_BASE_URL")
+    with key_pool_lock:
+        clients = async_openai_clients.setdefault(loop, {})
+        client = clients.get((apikey, base_url))
+        if client is None:
+            client = AsyncOpenAI(api_key=apikey)
+            clients[(apikey, base_url)] = client
+
+    return client
+
+
+def get_key_usage():
+    """
+    Returns the usage of each key of the pool for monitoring (the keys are masked)
+    :return usage (list): one dict per key
+    """
+    with key_pool_lock:
+        now = time.time()
+        usage = []
+        for state in load_api_keys():
+            recent_requests, recent_tokens, recent_errors = get_recent_usage(state, now)
+            usage.append({
+                'key': mask_api_key(state['key']),
+                'in_flight': state['in_flight'],
+                'requests': state['requests'],
+                'prompt_tokens': state['prompt_tokens'],
+                'completion_tokens': state['completion_tokens'],
+                'throttled': state['throttled'],
+                'errors': state['errors'],
+                'errors_per_minute': recent_errors * 60 / USAGE_WINDOW_SECONDS,
+                'requests_per_minute': recent_requests * 60 / USAGE_WINDOW_SECONDS,
+                'tokens_per_minute': recent_tokens * 60 / USAGE_WINDOW_SECONDS,
+                'cooldown_seconds': max(0.0, state['cooldown_until'] - now),
+            })
+
+    return usage
+
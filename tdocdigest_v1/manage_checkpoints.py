@@ -0,0 +1,184 @@
+"""
+This file handles stage checkpoints for the TDoc Digest
+Each stage of a summary request (download, text, summary, score) saves its result in a checkpoint
+keyed by (meeting, TDoc, input hash). A retry of the same request resumes from the last completed stage.
+"""
+import os
+import glob
+import time
+import hashlib
+import logging
+import pickle
+import threading
+from manage_common import get_file_path
+
+# Stages of a summary request
+STAGE_DOWNLOAD = 'download'
+STAGE_TEXT = 'text'
+STAGE_SUMMARY = 'summary'
+STAGE_SCORE = 'score'
+
+# Checkpoints older than this are deleted by cleanup_checkpoints
+CHECKPOINT_MAX_AGE_HOURS = 24 * 7
+
+# Minimum time between two automatic clean ups in the same process
+CHECKPOINT_CLEANUP_INTERVAL_SECONDS = 3600
+
+# Time of the last automatic clean up
+last_cleanup = {'time': 0.0}
+cleanup_lock = threading.Lock()
+
+
+def get_checkpoint_root():
+    """
+    Returns the folder where the checkpoints are saved
+    :return (str): checkpoint folder name
+    """
+    return './checkpoints'
+
+
+def get_input_hash(*parts):
+    """
+    Returns the hash of the inputs of a stage
+    :param parts (str, bytes, bool): inputs of the stage
+    :return (str): hex digest
+    """
+    input_hash = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        input_hash.update(part)
+        input_hash.update(b'\0')
+
+    return input_hash.hexdigest()
+
+
+def create_checkpoint_folder(meetingid, tdocnumber):
+    """
+    Creates the checkpoint folder of the TDoc
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :return checkpoint_folder (str): checkpoint folder name
+    """
+    checkpoint_folder = os.path.join(get_checkpoint_root(), meetingid, tdocnumber)
+    try:
+        os.makedirs(checkpoint_folder, exist_ok=True)
+    except OSError as e:
+        # Raise the error/exception
+        raise e
+
+    return checkpoint_folder
+
+
+def get_checkpoint_file(meetingid, tdocnumber, stage, inputhash):
+    """
+    Returns the checkpoint file of a stage
+    checkpoint file format is <stage>_<inputhash>.pkl in the folder checkpoints/<meetingid>/<tdocnumber>
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param stage (str): stage name
+    :param inputhash (str): hash of the inputs of the stage (from get_input_hash)
+    :return (str): checkpoint file full path
+    """
+    return get_file_path(os.path.join(get_checkpoint_root(), meetingid, tdocnumber), stage + '_' + inputhash + '.pkl')
+
+
+def load_checkpoint(meetingid, tdocnumber, stage, inputhash):
+    """
+    Loads the result of a completed stage
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param stage (str): stage name
+    :param inputhash (str): hash of the inputs of the stage
+    :return: the saved result or None if the stage was not completed with the same inputs
+    """
+    checkpoint_file = get_checkpoint_file(meetingid, tdocnumber, stage, inputhash)
+    if not os.path.exists(checkpoint_file):
+        return None
+
+    try:
+        with open(checkpoint_file, 'rb') as file:
+            value = pickle.load(file)
+        logging.info(f"Checkpoint loaded {checkpoint_file}")
+        return value
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logging.error(f"Error loading checkpoint {checkpoint_file}: {e}")
+        return None
+
+
+def save_checkpoint(meetingid, tdocnumber, stage, inputhash, value):
+    """
+    Saves the result of a completed stage. Checkpoints of the same stage with other inputs are deleted.
+    The checkpoint is written to a temporary file first so that a failure does not leave a partial checkpoint.
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param stage (str): stage name
+    :param inputhash (str): hash of the inputs of the stage
+    :param value: result of the stage
+    :return: None
+    """
+    checkpoint_folder = create_checkpoint_folder(meetingid, tdocnumber)
+    checkpoint_file = get_checkpoint_file(meetingid, tdocnumber, stage, inputhash)
+
+    try:
+        temp_file = f"{checkpoint_file}.{os.getpid()}_{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as file:
+            pickle.dump(value, file)
+        os.replace(temp_file, checkpoint_file)
+        logging.info(f"Checkpoint saved {checkpoint_file}")
+    except (OSError, pickle.PicklingError) as e:
+        # A checkpoint is not required for the request, only log the error
+        logging.error(f"Error saving checkpoint {checkpoint_file}: {e}")
+        return
+
+    for old_file in glob.glob(get_file_path(checkpoint_folder, stage + '_*.pkl')):
+        if old_file != checkpoint_file:
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+
+
+def cleanup_checkpoints(maxagehours=CHECKPOINT_MAX_AGE_HOURS):
+    """
+    Deletes the checkpoints older than maxagehours and the empty checkpoint folders
+    :param maxagehours (float): maximum age of a checkpoint in hours
+    :return removed (int): number of checkpoint files deleted
+    """
+    checkpoint_root = get_checkpoint_root()
+    oldest = time.time() - maxagehours * 3600
+    removed = 0
+
+    for folder, _, files in os.walk(checkpoint_root, topdown=False):
+        for filename in files:
+            checkpoint_file = get_file_path(folder, filename)
+            try:
+                if os.path.getmtime(checkpoint_file) < oldest:
+                    os.remove(checkpoint_file)
+                    removed += 1
+            except OSError:
+                # Deleted by another request
+                pass
+        if folder != checkpoint_root:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                # Folder is not empty
+                pass
+
+    logging.info(f"Checkpoint clean up: {removed} files deleted")
+    return removed
+
+
+def cleanup_checkpoints_periodically():
+    """
+    Runs cleanup_checkpoints at most once per CHECKPOINT_CLEANUP_INTERVAL_SECONDS in this process
+    :return: None
+    """
+    with cleanup_lock:
+        if time.time() - last_cleanup['time'] < CHECKPOINT_CLEANUP_INTERVAL_SECONDS:
+            return
+        last_cleanup['time'] = time.time()
+
+    cleanup_checkpoints()
+
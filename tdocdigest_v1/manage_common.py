@@ -2,6 +2,8 @@
 This file handles common functions for the TDoc Digest
 """
 import os
+import re
+import logging
 
 
 def get_file_path(folder, filename):
@@ -16,3 +18,48 @@ def get_file_path(folder, filename):
     str: The full path to the file.
     """
     return os.path.join(folder, filename)
+
+
+def parse_agenda_item(text):
+    """
+    Returns the agenda item found in the header of a TDoc or a generated summary.
+
+    Args:
+    text (str): The text of the TDoc or the summary (Example: 'Agenda Item: 9.1.2').
+
+    Returns:
+    str: The agenda item (Example: '9.1.2') or an empty string if not found.
+    """
+    match = re.search(r'agenda\s*item\s*[:#\-]?[\s*]*(\d+(?:\.\d+)*)', text, re.IGNORECASE)
+    if match is None:
+        return ''
+
+    return match.group(1)
+
+
+def format_openai_error(exception):
+    """
+    Returns the error message shown for an exception raised by the OpenAI API.
+
+    Args:
+    exception (Exception): The exception raised by the OpenAI API call.
+
+    Returns:
+    str: The error message (authentication, rate limit, invalid request or unexpected error).
+    """
+    err = str(exception)
+    logging.error(f"OpenAI API returned an error: {err}")
+    if "authentication" in err.lower():
+        err = f"Authentication failed. Check your API key. {err}"
+        logging.error(err)
+    if "rate limit" in err.lower():
+        err = f"Rate limit exceeded. Try again later. {err}"
+        logging.error(err)
+    if "invalid" in err.lower():
+        err = f"The request was invalid. Check your parameters. {err}"
+        logging.error(err)
+    else:
+        err = f"An unexpected OpenAI error occurred.{err}"
+        logging.error(err)
+
+    return err
@@ -0,0 +1,248 @@
+"""
+This file handles disk quotas for the TDoc Digest
+The log_<meetingid>, digestdata, checkpoints and batchdata folders are created in the current folder and grow
+with every request. The janitor deletes the files older than the age quota of the folder and then the oldest
+files until the folder is below its size quota. Working folders (download_<meetingid>) left behind by failed
+requests are deleted when nothing in them was modified for ORPHAN_AGE_SECONDS.
+"""
+import os
+import time
+import fnmatch
+import logging
+import argparse
+import threading
+
+# Age and size quotas. Only the files matching 'files' are deleted (indexes in digestdata are kept).
+DISK_QUOTAS = [
+    {'folders': 'log_*', 'files': '*', 'max_age_days': 30, 'max_bytes': 1 * 1024 ** 3},
+    {'folders': 'digestdata', 'files': 'data_*.pkl', 'max_age_days': 365, 'max_bytes': 5 * 1024 ** 3},
+    {'folders': 'checkpoints', 'files': '*.pkl', 'max_age_days': 7, 'max_bytes': 2 * 1024 ** 3},
+    {'folders': 'batchdata', 'files': '*.jsonl', 'max_age_days': 30, 'max_bytes': 1 * 1024 ** 3},
+]
+
+# Working folders (create_working_folder) are deleted at the end of each request
+WORKING_FOLDER_PATTERN = 'download_*'
+ORPHAN_AGE_SECONDS = 3600
+
+# Time between two runs of the background janitor
+JANITOR_INTERVAL_SECONDS = 3600
+
+# Background janitor thread (one per process)
+janitor = {'thread': None}
+janitor_lock = threading.Lock()
+
+
+def scan_files(folder):
+    """
+    Lists the files in the folder and its sub folders
+    :param folder (str): folder path
+    :return files (list): (mtime, size, path) of each file
+    :return folders (list): sub folder paths, deepest first
+    """
+    files = []
+    folders = []
+    for current_folder, sub_folders, file_names in os.walk(folder, topdown=False):
+        for file_name in file_names:
+            path = os.path.join(current_folder, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Deleted by a request
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        if current_folder != folder:
+            folders.append(current_folder)
+
+    return files, folders
+
+
+def remove_empty_folders(folders, dryrun):
+    """
+    Deletes the empty folders
+    :param folders (list): folder paths, deepest first
+    :param dryrun (bool): only count, do not delete
+    :return removed (int): number of folders deleted
+    """
+    removed = 0
+    for folder in folders:
+        try:
+            if not os.listdir(folder):
+                if not dryrun:
+                    os.rmdir(folder)
+                removed += 1
+        except OSError:
+            pass
+
+    return removed
+
+
+def enforce_quota(folder, quota, dryrun=False):
+    """
+    Deletes the files of the folder which are older than the age quota, then the oldest files until
+    the files matching the quota are below the size quota
+    :param folder (str): folder path
+    :param quota (dict): quota from DISK_QUOTAS
+    :param dryrun (bool): only report, do not delete
+    :return report (dict): folder, files, bytes, reclaimed bytes and reclaimed inodes
+    """
+    files, folders = scan_files(folder)
+    total_bytes = sum(size for _, size, _ in files)
+    oldest = time.time() - quota['max_age_days'] * 86400
+
+    report = {'folder': folder, 'files': len(files), 'bytes': total_bytes, 'reclaimed_bytes': 0,
+              'reclaimed_inodes': 0}
+    # Only the files matching the quota count against the size quota (the other files are never deleted)
+    quota_files = [(mtime, size, path) for mtime, size, path in files
+                   if fnmatch.fnmatch(os.path.basename(path), quota['files'])]
+    remaining_bytes = sum(size for _, size, _ in quota_files)
+    for mtime, size, path in sorted(quota_files):
+        if mtime >= oldest and remaining_bytes <= quota['max_bytes']:
+            # Files are sorted oldest first, the rest is within the quotas
+            break
+        try:
+            if not dryrun:
+                os.remove(path)
+        except OSError as e:
+            logging.error(f"Error deleting {path}: {e}")
+            continue
+        remaining_bytes -= size
+        report['reclaimed_bytes'] += size
+        report['reclaimed_inodes'] += 1
+
+    report['reclaimed_inodes'] += remove_empty_folders(folders, dryrun)
+    return report
+
+
+def sweep_orphan_working_folders(root, dryrun=False):
+    """
+    Deletes the working folders where nothing was modified for ORPHAN_AGE_SECONDS
+    (left behind by requests which failed before delete_working_folder)
+    :param root (str): folder where the working folders are created
+    :param dryrun (bool): only report, do not delete
+    :return reports (list): report of each orphan working folder
+    """
+    reports = []
+    oldest = time.time() - ORPHAN_AGE_SECONDS
+    for name in sorted(os.listdir(root)):
+        folder = os.path.join(root, name)
+        if not fnmatch.fnmatch(name, WORKING_FOLDER_PATTERN) or not os.path.isdir(folder):
+            continue
+
+        files, folders = scan_files(folder)
+        try:
+            newest = max([mtime for mtime, _, _ in files] + [os.path.getmtime(folder)])
+        except OSError:
+            # Deleted by delete_working_folder at the end of a request
+            continue
+        if newest >= oldest:
+            # In use by a request
+            continue
+
+        report = {'folder': folder, 'files': len(files), 'bytes': sum(size for _, size, _ in files),
+                  'reclaimed_bytes': 0, 'reclaimed_inodes': 0}
+        for _, size, path in files:
+            try:
+                if not dryrun:
+                    os.remove(path)
+            except OSError:
+                continue
+            report['reclaimed_bytes'] += size
+            report['reclaimed_inodes'] += 1
+        report['reclaimed_inodes'] += remove_empty_folders(folders + [folder], dryrun)
+        logging.info(f"Orphan working folder {folder}: {report['reclaimed_inodes']} inodes deleted")
+        reports.append(report)
+
+    return reports
+
+
+def run_janitor(root='.', dryrun=False):
+    """
+    Applies the disk quotas and deletes the orphan working folders
+    :param root (str): folder where the log, working and data folders are created
+    :param dryrun (bool): only report, do not delete
+    :return reports (list): report of each folder (see enforce_quota)
+    """
+    reports = []
+    for name in sorted(os.listdir(root)):
+        folder = os.path.join(root, name)
+        if not os.path.isdir(folder):
+            continue
+        for quota in DISK_QUOTAS:
+            if fnmatch.fnmatch(name, quota['folders']):
+                reports.append(enforce_quota(folder, quota, dryrun))
+                break
+
+    reports += sweep_orphan_working_folders(root, dryrun)
+
+    reclaimed_bytes = sum(report['reclaimed_bytes'] for report in reports)
+    reclaimed_inodes = sum(report['reclaimed_inodes'] for report in reports)
+    logging.info(f"Janitor{' (dry run)' if dryrun else ''}: reclaimed {reclaimed_bytes} bytes, "
+                 f"{reclaimed_inodes} inodes")
+    return reports
+
+
+def format_size(size):
+    """
+    Formats a size in bytes (Example: 1536 -> 1.5 KB)
+    :param size (int): size in bytes
+    :return (str): size with unit
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+
+
+def format_janitor_report(reports):
+    """
+    Formats the janitor reports as text
+    :param reports (list): reports from run_janitor
+    :return (str): one line per folder and the total
+    """
+    lines = []
+    for report in reports:
+        lines.append(f"{report['folder']}: {report['files']} files, {format_size(report['bytes'])}, "
+                     f"reclaimed {format_size(report['reclaimed_bytes'])}, {report['reclaimed_inodes']} inodes")
+    lines.append(f"Total reclaimed: {format_size(sum(report['reclaimed_bytes'] for report in reports))}, "
+                 f"{sum(report['reclaimed_inodes'] for report in reports)} inodes")
+
+    return '\n'.join(lines)
+
+
+def janitor_loop(root, interval):
+    """
+    Runs the janitor every interval seconds (background thread)
+    :param root (str): folder where the log, working and data folders are created
+    :param interval (float): seconds between two runs
+    :return: None
+    """
+    while True:
+        try:
+            run_janitor(root)
+        except Exception as e:
+            logging.error(f"Janitor error: {e}")
+        time.sleep(interval)
+
+
+def start_janitor(root='.', interval=JANITOR_INTERVAL_SECONDS):
+    """
+    Starts the background janitor (once per process)
+    :param root (str): folder where the log, working and data folders are created
+    :param interval (float): seconds between two runs
+    :return: None
+    """
+    with janitor_lock:
+        if janitor['thread'] is not None and janitor['thread'].is_alive():
+            return
+        janitor['thread'] = threading.Thread(target=janitor_loop, args=(os.path.abspath(root), interval),
+                                             name='tdocdigest-janitor', daemon=True)
+        janitor['thread'].start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest disk quotas and orphan working folders')
+    parser.add_argument('--root', default='.', help='folder where the log, working and data folders are created')
+    parser.add_argument('--dry-run', action='store_true', help='only report, do not delete')
+    args = parser.parse_args()
+
+    print(format_janitor_report(run_janitor(args.root, args.dry_run)))
@@ -0,0 +1,275 @@
+"""
+This file handles profiling of requests for the TDoc Digest
+A profiled request saves a cProfile file and the top allocation sites (tracemalloc) next to its log file:
+log_<meetingid>_<tdocnumber>_<timestamp>.prof and log_<meetingid>_<tdocnumber>_<timestamp>.alloc.json
+Only one request is profiled at a time (the profilers are process wide).
+Running this file lists the slowest functions and the biggest allocators of the recent profiled requests.
+"""
+import os
+import io
+import glob
+import json
+import time
+import random
+import logging
+import pstats
+import cProfile
+import resource
+import argparse
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Environment variable with the percentage of requests profiled (for example 5 profiles 5% of the requests)
+PROFILE_PERCENT_ENV = 'TDOCDIGEST_PROFILE_PERCENT'
+
+# Number of allocation sites saved for each request
+TOP_ALLOCATION_SITES = 25
+
+# Number of frames saved by tracemalloc for each allocation
+TRACEMALLOC_FRAMES = 10
+
+# cProfile (sys.monitoring from Python 3.12) and tracemalloc are process wide, so only one request is profiled
+# at a time. The requests started during the profile are counted (their calls are included in the profile).
+profiling = {'active': False, 'concurrent_requests': 0, 'skipped_profiles': 0}
+profiling_lock = threading.Lock()
+
+
+def should_profile(requested=False):
+    """
+    Decides whether the request is profiled
+    :param requested (bool): profiling requested for this request
+    :return (bool): True if the request is requested or sampled (PROFILE_PERCENT_ENV)
+    """
+    with profiling_lock:
+        if profiling['active']:
+            # Another request is profiled, the request is not sampled
+            if requested:
+                logging.warning("Profiling not available for this request, another request is profiled")
+            return False
+
+    if requested:
+        return True
+
+    try:
+        percent = float(os.getenv(PROFILE_PERCENT_ENV, '0'))
+    except ValueError:
+        logging.warning(f"Invalid {PROFILE_PERCENT_ENV}: {os.getenv(PROFILE_PERCENT_ENV)}")
+        return False
+
+    return random.random() * 100 < percent
+
+
+def get_profile_files(logpath):
+    """
+    Returns the profile files saved next to the log file
+    :param logpath (str): log file full path
+    :return profilefile (str), allocfile (str): cProfile file and allocation file full paths
+    """
+    base = logpath[:-len('.log')] if logpath.endswith('.log') else logpath
+    return base + '.prof', base + '.alloc.json'
+
+
+@contextmanager
+def profile_request(session, enabled=True):
+    """
+    Profiles the code in the with block (CPU with cProfile, memory with tracemalloc)
+    The files are saved next to the log file of the request (session["log_path"] when the block ends).
+    Only one request is profiled at a time: the profile is skipped if another request is profiled. The requests
+    running at the same time are counted in the saved summary, their calls and allocations are included.
+    :param session (dict): session state of the request
+    :param enabled (bool): Whether to profile or not
+    """
+    with profiling_lock:
+        if profiling['active']:
+            # Counted in the profile of the other request
+            profiling['concurrent_requests'] += 1
+            if enabled:
+                profiling['skipped_profiles'] += 1
+                logging.warning("Profile skipped, another request is profiled")
+            enabled = False
+        elif enabled:
+            profiling.update({'active': True, 'concurrent_requests': 0, 'skipped_profiles': 0})
+
+    if not enabled:
+        yield
+        return
+
+    profiler = None
+    started_tracing = False
+    try:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is active (not started by profile_request)
+            logging.warning(f"CPU profiling not available for this request: {e}")
+            profiler = None
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        snapshot_before = tracemalloc.take_snapshot()
+    except Exception as e:
+        # The request runs without a profile, the next requests can be profiled
+        logging.error(f"Profile not started: {e}")
+        if profiler is not None:
+            profiler.disable()
+        if started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        with profiling_lock:
+            profiling['active'] = False
+        enabled = False
+
+    if not enabled:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    # CPU time of the thread running the request (process_time includes the other threads)
+    start_cpu = time.thread_time()
+
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start_time
+        cpu_time = time.thread_time() - start_cpu
+        if profiler is not None:
+            profiler.disable()
+
+        snapshot_after = tracemalloc.take_snapshot()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+
+        with profiling_lock:
+            concurrency = {'concurrent_requests': profiling['concurrent_requests'],
+                           'skipped_profiles': profiling['skipped_profiles']}
+            profiling['active'] = False
+
+        log_path = session.get("log_path", '')
+        if log_path:
+            save_profile(log_path, profiler, snapshot_before, snapshot_after, wall_time, cpu_time, peak_memory,
+                         concurrency)
+        else:
+            logging.warning("Profile not saved, the request has no log file")
+
+
+def save_profile(logpath, profiler, snapshotbefore, snapshotafter, walltime, cputime, peakmemory, concurrency=None):
+    """
+    Saves the cProfile stats and the top allocation sites next to the log file
+    :param logpath (str): log file full path
+    :param profiler (cProfile.Profile): profiler of the request (None if CPU profiling was not available)
+    :param snapshotbefore (tracemalloc.Snapshot): snapshot at the start of the request
+    :param snapshotafter (tracemalloc.Snapshot): snapshot at the end of the request
+    :param walltime (float): duration of the request in seconds
+    :param cputime (float): CPU time of the thread of the request in seconds
+    :param peakmemory (int): peak traced memory in bytes
+    :param concurrency (dict): requests started and profiles skipped during the request
+    :return: None
+    """
+    profile_file, alloc_file = get_profile_files(logpath)
+
+    try:
+        if profiler is not None:
+            profiler.dump_stats(profile_file)
+
+        allocation_sites = []
+        for stat in snapshotafter.compare_to(snapshotbefore, 'lineno')[:TOP_ALLOCATION_SITES]:
+            frame = stat.traceback[0]
+            allocation_sites.append({'file': frame.filename, 'line': frame.lineno,
+                                     'size_diff': stat.size_diff, 'count_diff': stat.count_diff,
+                                     'size': stat.size})
+
+        profile_summary = {
+            'log_path': logpath,
+            'wall_time': walltime,
+            'cpu_time': cputime,
+            'peak_traced_memory': peakmemory,
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            # The profile and the allocation sites include the calls of these requests
+            'concurrent_requests': (concurrency or {}).get('concurrent_requests', 0),
+            'skipped_profiles': (concurrency or {}).get('skipped_profiles', 0),
+            'allocation_sites': allocation_sites,
+        }
+        with open(alloc_file, 'w', encoding='utf-8') as file:
+            json.dump(profile_summary, file, indent=1)
+
+        logging.info(f"Profile saved {profile_file}, {alloc_file} (wall {walltime:.3f}s, cpu {cputime:.3f}s)")
+
+    except OSError as e:
+        logging.error(f"Error saving the profile of {logpath}: {e}")
+
+
+def find_recent_profiles(folder, recent):
+    """
+    Finds the allocation files of the most recent profiled requests
+    :param folder (str): folder containing the log_<meetingid> folders
+    :param recent (int): number of requests
+    :return (list): allocation file full paths, newest first
+    """
+    alloc_files = glob.glob(os.path.join(folder, 'log_*', '*.alloc.json'))
+    alloc_files.sort(key=os.path.getmtime, reverse=True)
+    return alloc_files[:recent]
+
+
+def report_profiles(folder='.', recent=20, top=15):
+    """
+    Creates a report of the slowest functions and the biggest allocators of the recent profiled requests
+    :param folder (str): folder containing the log_<meetingid> folders
+    :param recent (int): number of requests included
+    :param top (int): number of functions and allocation sites listed
+    :return report (str): report text
+    """
+    alloc_files = find_recent_profiles(folder, recent)
+    if not alloc_files:
+        return 'No profiled requests found'
+
+    report = io.StringIO()
+    report.write(f"Profiled requests ({len(alloc_files)}):\n")
+
+    profile_files = []
+    allocators = {}
+    for alloc_file in alloc_files:
+        try:
+            with open(alloc_file, 'r', encoding='utf-8') as file:
+                profile_summary = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading {alloc_file}: {e}")
+            continue
+
+        report.write(f"  {profile_summary['log_path']}: wall {profile_summary['wall_time']:.3f}s, "
+                     f"cpu {profile_summary['cpu_time']:.3f}s, "
+                     f"peak traced {profile_summary['peak_traced_memory'] / 1e6:.1f}MB, "
+                     f"max rss {profile_summary['max_rss_kb'] / 1e3:.1f}MB, "
+                     f"concurrent requests {profile_summary.get('concurrent_requests', 0)}, "
+                     f"skipped profiles {profile_summary.get('skipped_profiles', 0)}\n")
+        for site in profile_summary['allocation_sites']:
+            key = f"{site['file']}:{site['line']}"
+            allocators[key] = allocators.get(key, 0) + site['size_diff']
+
+        profile_file = alloc_file[:-len('.alloc.json')] + '.prof'
+        if os.path.exists(profile_file):
+            profile_files.append(profile_file)
+
+    if profile_files:
+        report.write(f"\nSlowest functions (cumulative time, {len(profile_files)} requests):\n")
+        stats = pstats.Stats(*profile_files, stream=report)
+        stats.sort_stats('cumulative').print_stats(top)
+
+    report.write(f"\nBiggest allocators (memory allocated during the requests):\n")
+    for key, size in sorted(allocators.items(), key=lambda item: item[1], reverse=True)[:top]:
+        report.write(f"  {size / 1e3:12.1f} KB  {key}\n")
+
+    return report.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest profiles of recent requests')
+    parser.add_argument('--folder', default='.', help='folder containing the log_<meetingid> folders')
+    parser.add_argument('--recent', type=int, default=20, help='number of recent profiled requests')
+    parser.add_argument('--top', type=int, default=15, help='number of functions and allocators listed')
+    args = parser.parse_args()
+
+    print(report_profiles(args.folder, args.recent, args.top))
@@ -0,0 +1,408 @@
+"""
+This file handles the TDoc list of a meeting for the TDoc Digest
+3GPP publishes the TDoc list of each meeting as a spreadsheet (TDoc number, title, source, type, agenda item,
+status). The list is downloaded once per meeting, refreshed with a conditional request (ETag/Last-Modified)
+and saved in an indexed SQLite table (digestdata/tdoclist.db), so the TDoc numbers can be validated and the
+TDocs filtered by agenda item or source without downloading the documents.
+A local file (.xlsx or .csv) can be used instead of the 3GPP site (TDOCDIGEST_TDOC_LIST or listfile).
+"""
+import os
+import io
+import re
+import csv
+import time
+import sqlite3
+import logging
+import zipfile
+import argparse
+import threading
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import quote
+import requests
+from handle_datafiles import create_data_folder
+from generate_summary import TDOC_BASE_URL
+
+# TDoc list file of the meeting in the Docs folder (Example: TDoc_List_Meeting_RAN1#118.xlsx)
+TDOC_LIST_FILE_NAME = "TDoc_List_Meeting_RAN1#{meetingid}.xlsx"
+
+# Environment variable with a local TDoc list file ({meetingid} is replaced by the meeting id)
+TDOC_LIST_ENV = 'TDOCDIGEST_TDOC_LIST'
+
+# Time before the list of a meeting is checked again on the 3GPP site
+TDOC_LIST_MAX_AGE_SECONDS = 3600
+
+# Column names of the TDoc list -> column of the tdocs table
+TDOC_LIST_COLUMNS = {
+    'tdoc': 'tdoc',
+    'title': 'title',
+    'source': 'source',
+    'type': 'type',
+    'agenda item': 'agenda_item',
+    'tdoc status': 'status',
+}
+
+TDOC_TABLE_COLUMNS = ['tdoc', 'title', 'source', 'type', 'agenda_item', 'status']
+
+# Namespace of the spreadsheet xml files
+XLSX_NAMESPACE = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+# Only one refresh of a meeting list at a time (one lock per meeting)
+refresh_locks = {}
+refresh_locks_lock = threading.Lock()
+
+
+def get_refresh_lock(meetingid):
+    """
+    Returns the lock of the refreshes of a meeting list
+    :param meetingid (str): meeting id
+    :return (threading.Lock): lock of the meeting
+    """
+    with refresh_locks_lock:
+        return refresh_locks.setdefault(meetingid, threading.Lock())
+
+
+def get_tdoc_list_db():
+    """
+    Returns the SQLite file of the TDoc lists
+    :return (str): database file path
+    """
+    return os.path.join(create_data_folder(), 'tdoclist.db')
+
+
+def connect_tdoc_list_db():
+    """
+    Opens the TDoc list database and creates the tables and indexes
+    :return connection (sqlite3.Connection): database connection
+    """
+    connection = sqlite3.connect(get_tdoc_list_db(), timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS tdocs (
+            meeting TEXT NOT NULL, tdoc TEXT NOT NULL, title TEXT, source TEXT, type TEXT,
+            agenda_item TEXT, status TEXT, PRIMARY KEY (meeting, tdoc));
+        CREATE INDEX IF NOT EXISTS tdocs_agenda_item ON tdocs (meeting, agenda_item);
+        CREATE INDEX IF NOT EXISTS tdocs_source ON tdocs (meeting, source);
+        CREATE TABLE IF NOT EXISTS lists (
+            meeting TEXT PRIMARY KEY, location TEXT, etag TEXT, last_modified TEXT, checked REAL, tdocs INTEGER);
+    """)
+    return connection
+
+
+def get_column_index(cellref):
+    """
+    Returns the column index of a spreadsheet cell reference (Example: C12 -> 2)
+    :param cellref (str): cell reference
+    :return (int): column index (0 for column A)
+    """
+    index = 0
+    for letter in re.match(r'[A-Z]+', cellref).group():
+        index = index * 26 + ord(letter) - ord('A') + 1
+
+    return index - 1
+
+
+def read_xlsx_rows(content):
+    """
+    Reads the rows of the first sheet of a spreadsheet (.xlsx)
+    :param content (bytes): content of the .xlsx file
+    :return rows (list): list of rows, each row is a list of cell texts
+    """
+    with zipfile.ZipFile(io.BytesIO(content)) as xlsx:
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in xlsx.namelist():
+            root = ElementTree.fromstring(xlsx.read('xl/sharedStrings.xml'))
+            for item in root.iter(XLSX_NAMESPACE + 'si'):
+                shared_strings.append(''.join(text.text or '' for text in item.iter(XLSX_NAMESPACE + 't')))
+
+        sheets = sorted(name for name in xlsx.namelist() if re.match(r'xl/worksheets/sheet\d+\.xml$', name))
+        sheet = 'xl/worksheets/sheet1.xml' if 'xl/worksheets/sheet1.xml' in sheets else sheets[0]
+        root = ElementTree.fromstring(xlsx.read(sheet))
+
+    rows = []
+    for row in root.iter(XLSX_NAMESPACE + 'row'):
+        cells = []
+        for cell in row.iter(XLSX_NAMESPACE + 'c'):
+            column = get_column_index(cell.get('r')) if cell.get('r') else len(cells)
+            cell_type = cell.get('t')
+            if cell_type == 'inlineStr':
+                text = ''.join(text.text or '' for text in cell.iter(XLSX_NAMESPACE + 't'))
+            else:
+                value = cell.find(XLSX_NAMESPACE + 'v')
+                text = value.text if value is not None and value.text is not None else ''
+                if cell_type == 's' and text != '':
+                    text = shared_strings[int(text)]
+            cells += [''] * (column + 1 - len(cells))
+            cells[column] = text
+        rows.append(cells)
+
+    return rows
+
+
+def read_csv_rows(content):
+    """
+    Reads the rows of a CSV file
+    :param content (bytes): content of the .csv file
+    :return rows (list): list of rows, each row is a list of cell texts
+    """
+    return list(csv.reader(io.StringIO(content.decode('utf-8-sig'))))
+
+
+def parse_tdoc_list(content, filename):
+    """
+    Parses a TDoc list (.xlsx or .csv)
+    The header row is the first row with a 'TDoc' column, the columns not in TDOC_LIST_COLUMNS are ignored
+    :param content (bytes): content of the file
+    :param filename (str): file name or url (the extension gives the format)
+    :return tdocs (list): one dict per TDoc with the keys of TDOC_TABLE_COLUMNS
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    try:
+        if filename.lower().endswith('.csv'):
+            rows = read_csv_rows(content)
+        else:
+            rows = read_xlsx_rows(content)
+    except (zipfile.BadZipFile, ElementTree.ParseError, UnicodeDecodeError, KeyError, IndexError) as e:
+        err = f"Error reading the TDoc list {filename}: {e}"
+        logging.error(err)
+        return [], err
+
+    for header_index, row in enumerate(rows):
+        header = [cell.strip().lower() for cell in row]
+        if 'tdoc' in header:
+            break
+    else:
+        err = f"No TDoc column found in the TDoc list {filename}"
+        logging.error(err)
+        return [], err
+
+    columns = {TDOC_LIST_COLUMNS[name]: index for index, name in enumerate(header) if name in TDOC_LIST_COLUMNS}
+    tdocs = []
+    for row in rows[header_index + 1:]:
+        tdoc = {column: (row[index].strip() if index < len(row) else '') for column, index in columns.items()}
+        if not tdoc['tdoc']:
+            continue
+        for column in TDOC_TABLE_COLUMNS:
+            tdoc.setdefault(column, '')
+        tdocs.append(tdoc)
+
+    return tdocs, ''
+
+
+def get_tdoc_list_location(meetingid, listfile=None):
+    """
+    Returns the location of the TDoc list of the meeting
+    :param meetingid (str): meeting id
+    :param listfile (str): local TDoc list file (if None, TDOC_LIST_ENV or the 3GPP site is used)
+    :return (str): local file path or url
+    """
+    if listfile is None:
+        listfile = os.getenv(TDOC_LIST_ENV)
+    if listfile:
+        return listfile.replace('{meetingid}', meetingid)
+
+    tdoc_base_url = os.getenv("TDOCDIGEST_TDOC_URL", TDOC_BASE_URL)
+    return tdoc_base_url + "/TSGR1_" + meetingid + "/Docs/" + quote(TDOC_LIST_FILE_NAME.format(meetingid=meetingid))
+
+
+def fetch_tdoc_list(location, etag=None, lastmodified=None):
+    """
+    Reads the TDoc list from a local file or downloads it with a conditional request
+    :param location (str): local file path or url
+    :param etag (str): ETag of the saved list (None if not saved)
+    :param lastmodified (str): Last-Modified of the saved list (None if not saved)
+    :return content (bytes): content of the list, None if not modified since the saved list
+    :return etag (str): ETag of the list
+    :return lastmodified (str): Last-Modified of the list
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    if not location.lower().startswith(('http://', 'https://')):
+        try:
+            modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(os.path.getmtime(location)))
+            if modified == lastmodified:
+                return None, etag, lastmodified, ''
+            with open(location, 'rb') as file:
+                return file.read(), None, modified, ''
+        except OSError as e:
+            err = f"Error reading the TDoc list {location}: {e}"
+            logging.error(err)
+            return None, etag, lastmodified, err
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if lastmodified:
+        headers['If-Modified-Since'] = lastmodified
+
+    try:
+        response = requests.get(location, headers=headers, timeout=30)
+        if response.status_code == 304:
+            return None, etag, lastmodified, ''
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        err = f"Error downloading the TDoc list {location}: {e}"
+        logging.error(err)
+        return None, etag, lastmodified, err
+
+    return response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'), ''
+
+
+def refresh_tdoc_list(meetingid, listfile=None, maxage=TDOC_LIST_MAX_AGE_SECONDS, force=False):
+    """
+    Downloads the TDoc list of the meeting if it was not checked for maxage seconds and saves it in the database
+    The download is conditional, an unchanged list is not downloaded or parsed again
+    :param meetingid (str): meeting id
+    :param listfile (str): local TDoc list file (if None, TDOC_LIST_ENV or the 3GPP site is used)
+    :param maxage (float): seconds before the saved list is checked again
+    :param force (bool): check the list even if it was checked less than maxage seconds ago
+    :return count (int): number of TDocs saved for the meeting (0 if the list is not available)
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    location = get_tdoc_list_location(meetingid, listfile)
+    start_time = time.time()
+
+    connection = connect_tdoc_list_db()
+    try:
+        saved = connection.execute("SELECT * FROM lists WHERE meeting = ?", (meetingid,)).fetchone()
+        if saved is not None and saved['location'] == location and not force \
+                and start_time - saved['checked'] < maxage:
+            return saved['tdocs'], ''
+
+        with get_refresh_lock(meetingid):
+            saved = connection.execute("SELECT * FROM lists WHERE meeting = ?", (meetingid,)).fetchone()
+            if saved is not None and saved['location'] == location and saved['checked'] >= start_time:
+                # Checked by another request while waiting for the lock
+                return saved['tdocs'], ''
+
+            same_location = saved is not None and saved['location'] == location
+            content, etag, last_modified, err = fetch_tdoc_list(location,
+                                                                saved['etag'] if same_location else None,
+                                                                saved['last_modified'] if same_location else None)
+            if err != '':
+                # Not checked again before maxage (the TDoc numbers are not validated without the list)
+                count = saved['tdocs'] if same_location else 0
+                with connection:
+                    if not same_location:
+                        connection.execute("DELETE FROM tdocs WHERE meeting = ?", (meetingid,))
+                    connection.execute("INSERT OR REPLACE INTO lists VALUES (?, ?, ?, ?, ?, ?)",
+                                       (meetingid, location, etag, last_modified, time.time(), count))
+                return count, err
+
+            if content is None:
+                logging.info(f"TDoc list of meeting {meetingid} not modified")
+                with connection:
+                    connection.execute("UPDATE lists SET checked = ? WHERE meeting = ?", (time.time(), meetingid))
+                return saved['tdocs'], ''
+
+            tdocs, err = parse_tdoc_list(content, location)
+            if err != '':
+                return (saved['tdocs'] if same_location else 0), err
+
+            with connection:
+                connection.execute("DELETE FROM tdocs WHERE meeting = ?", (meetingid,))
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO tdocs (meeting, {', '.join(TDOC_TABLE_COLUMNS)}) "
+                    f"VALUES (?, {', '.join('?' * len(TDOC_TABLE_COLUMNS))})",
+                    [[meetingid] + [tdoc[column] for column in TDOC_TABLE_COLUMNS] for tdoc in tdocs])
+                connection.execute("INSERT OR REPLACE INTO lists VALUES (?, ?, ?, ?, ?, ?)",
+                                   (meetingid, location, etag, last_modified, time.time(), len(tdocs)))
+            logging.info(f"TDoc list of meeting {meetingid} saved: {len(tdocs)} tdocs")
+
+            return len(tdocs), ''
+
+    except sqlite3.Error as e:
+        err = f"Error saving the TDoc list of meeting {meetingid}: {e}"
+        logging.error(err)
+        return 0, err
+
+    finally:
+        connection.close()
+
+
+def find_tdoc(meetingid, tdocnumber):
+    """
+    Returns the saved TDoc list entry of the TDoc
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :return (dict): TDoc list entry, None if the TDoc is not in the saved list
+    """
+    connection = connect_tdoc_list_db()
+    try:
+        row = connection.execute("SELECT * FROM tdocs WHERE meeting = ? AND tdoc = ?",
+                                 (meetingid, tdocnumber)).fetchone()
+    finally:
+        connection.close()
+
+    return dict(row) if row is not None else None
+
+
+def get_tdoc_metadata(meetingid, tdocnumber, listfile=None):
+    """
+    Returns the TDoc list entry of the TDoc (the list is refreshed if needed)
+    A TDoc not in the list is looked up again after checking the list for new TDocs (conditional request,
+    the requests waiting for the same check do not check it again)
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param listfile (str): local TDoc list file (if None, TDOC_LIST_ENV or the 3GPP site is used)
+    :return metadata (dict): title, source, type, agenda_item and status, None if the TDoc is not in the list
+    :return available (bool): False if the TDoc list of the meeting is not available
+    """
+    count, _ = refresh_tdoc_list(meetingid, listfile)
+    if count == 0:
+        return None, False
+
+    row = find_tdoc(meetingid, tdocnumber)
+    if row is None:
+        refresh_tdoc_list(meetingid, listfile, force=True)
+        row = find_tdoc(meetingid, tdocnumber)
+
+    return row, True
+
+
+def filter_tdocs(meetingid, agendaitem=None, source=None, listfile=None):
+    """
+    Returns the TDocs of the meeting for an agenda item and/or a source (the list is refreshed if needed)
+    :param meetingid (str): meeting id
+    :param agendaitem (str): agenda item, its sub items are included (Example: 9.1 includes 9.1.2)
+    :param source (str): part of the source, case insensitive (Example: nokia)
+    :param listfile (str): local TDoc list file (if None, TDOC_LIST_ENV or the 3GPP site is used)
+    :return tdocs (list): TDoc list entries (dict) sorted by TDoc number
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    _, err = refresh_tdoc_list(meetingid, listfile)
+
+    query = "SELECT * FROM tdocs WHERE meeting = ?"
+    parameters = [meetingid]
+    if agendaitem:
+        query += " AND (agenda_item = ? OR agenda_item LIKE ?)"
+        parameters += [agendaitem, agendaitem + '.%']
+    if source:
+        query += " AND source LIKE ?"
+        parameters.append('%' + source + '%')
+
+    connection = connect_tdoc_list_db()
+    try:
+        rows = connection.execute(query + " ORDER BY tdoc", parameters).fetchall()
+    finally:
+        connection.close()
+
+    return [dict(row) for row in rows], err
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest TDoc list of a meeting')
+    parser.add_argument('meetingid')
+    parser.add_argument('--list', dest='listfile', help='local TDoc list file (.xlsx or .csv)')
+    parser.add_argument('--agenda', help='agenda item (sub items are included)')
+    parser.add_argument('--source', help='part of the source (Example: nokia)')
+    parser.add_argument('--refresh', action='store_true', help='check the TDoc list even if it was checked recently')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.refresh:
+        refresh_tdoc_list(args.meetingid, args.listfile, force=True)
+    filtered_tdocs, filter_err = filter_tdocs(args.meetingid, args.agenda, args.source, args.listfile)
+    for filtered_tdoc in filtered_tdocs:
+        print(f"{filtered_tdoc['tdoc']}\t{filtered_tdoc['agenda_item']}\t{filtered_tdoc['type']}\t"
+              f"{filtered_tdoc['source']}\t{filtered_tdoc['title']}")
+    if filter_err != '':
+        print(filter_err)
@@ -0,0 +1,451 @@
+"""
+This file handles the vector index of summaries and TDoc texts for the TDoc Digest
+The summary and the text of each TDoc are embedded (local hashing embedding or OpenAI embeddings) and saved in a
+memory-mapped float32 matrix (digestdata/vectors.f32) with an id map (digestdata/vectors.json).
+Related TDocs are found with a vectorized brute-force search. For a large corpus, an IVF index with int8
+quantized vectors (digestdata/vectors_ivf.npz) is built with build_ivf_index and used for the search.
+The index is written by the app, the batch ingest and the command line (several processes), the writes are
+serialized with a lock file (digestdata/vectors.lock).
+"""
+import os
+import re
+import json
+import time
+import zlib
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+import numpy as np
+from manage_common import get_file_path
+from handle_datafiles import create_data_folder
+from manage_apikeys import acquire_api_key, release_api_key, get_openai_client
+
+# Dimension of the local hashing embedding
+HASH_EMBEDDING_DIM = 512
+
+# Environment variable selecting the embedding function ('hash' or 'openai')
+EMBEDDING_ENV = 'TDOCDIGEST_EMBEDDING'
+OPENAI_EMBEDDING_MODEL = 'text-embedding-3-small'
+
+# Maximum number of characters of a TDoc text embedded
+MAX_EMBEDDING_TEXT_LENGTH = 20000
+
+# Kinds of vectors saved for a TDoc
+VECTOR_KIND_SUMMARY = 'summary'
+VECTOR_KIND_TEXT = 'text'
+
+# IVF index parameters (used when the index has more than IVF_MIN_ROWS vectors)
+IVF_MIN_ROWS = 50000
+IVF_NPROBE = 8
+IVF_KMEANS_ITERATIONS = 10
+IVF_RERANK_FACTOR = 8
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# The index is written by concurrent requests (one process), and by other processes (lock file)
+index_lock = threading.Lock()
+
+# Matrix and id map loaded by the queries, reloaded when the id map or the IVF index file changes
+index_cache = {'mtime': None, 'matrix': None, 'ids': [], 'positions': {}, 'ivf': None, 'ivf_stale': set()}
+
+
+def hash_embedding(texts, dim=HASH_EMBEDDING_DIM):
+    """
+    Local embedding without a model: hashed word and word pair counts (log scaled)
+    :param texts (list): texts to be embedded
+    :param dim (int): dimension of the vectors
+    :return (np.ndarray): float32 matrix (len(texts), dim)
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = re.findall(r'[a-z0-9][a-z0-9\-\.]*', text.lower())
+        features = words + [words[index] + ' ' + words[index + 1] for index in range(len(words) - 1)]
+        for feature in features:
+            feature_hash = zlib.crc32(feature.encode('utf-8'))
+            # The sign bit reduces the bias of hash collisions
+            vectors[row, feature_hash % dim] += 1.0 if (feature_hash >> 31) & 1 else -1.0
+    vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+
+    return vectors
+
+
+def openai_embedding(texts, model=OPENAI_EMBEDDING_MODEL):
+    """
+    Embedding with the OpenAI embeddings API
+    :param texts (list): texts to be embedded
+    :param model (str): embedding model
+    :return (np.ndarray): float32 matrix (len(texts), dimension of the model)
+    """
+    apikey, err = acquire_api_key()
+    if err != '':
+        raise RuntimeError(err)
+    try:
+        response = get_openai_client(apikey).embeddings.create(input=texts, model=model)
+    except Exception as e:
+        release_api_key(apikey, exception=e)
+        raise
+    release_api_key(apikey, response)
+    return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+
+def get_embedding_function():
+    """
+    Returns the embedding function selected with EMBEDDING_ENV (default: local hashing embedding)
+    :return (callable): function texts (list) -> float32 matrix
+    """
+    if os.getenv(EMBEDDING_ENV, 'hash') == 'openai':
+        return openai_embedding
+
+    return hash_embedding
+
+
+def normalize_vectors(vectors):
+    """
+    Normalizes the rows to unit length (dot product is the cosine similarity)
+    :param vectors (np.ndarray): matrix
+    :return (np.ndarray): float32 matrix with unit length rows
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def get_index_files(datafolder):
+    """
+    Returns the files of the vector index
+    :param datafolder (str): data folder
+    :return vectorfile (str), idfile (str), ivffile (str): matrix, id map and IVF index full paths
+    """
+    return (get_file_path(datafolder, 'vectors.f32'), get_file_path(datafolder, 'vectors.json'),
+            get_file_path(datafolder, 'vectors_ivf.npz'))
+
+
+@contextmanager
+def lock_vector_index(datafolder):
+    """
+    Locks the vector index against the writes of the other threads and processes
+    :param datafolder (str): data folder
+    :return: None
+    """
+    with index_lock, open(get_file_path(datafolder, 'vectors.lock'), 'a+b') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        else:
+            lockfile.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lockfile.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+            else:
+                lockfile.seek(0)
+                msvcrt.locking(lockfile.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_id_map(idfile, idmap):
+    """
+    Writes the id map of the vector index (atomic replace)
+    :param idfile (str): id map full path
+    :param idmap (dict): id map (see load_id_map)
+    :return: None
+    """
+    temp_file = idfile + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as file:
+        json.dump(idmap, file)
+    os.replace(temp_file, idfile)
+
+
+def load_id_map(idfile):
+    """
+    Loads the id map of the vector index
+    :param idfile (str): id map full path
+    :return (dict): {'dim': dimension, 'ids': [[meeting id, tdoc number, kind], ...] (row order of the matrix),
+                     'ivf_stale': rows of the IVF index replaced after the IVF build}
+    """
+    if not os.path.exists(idfile):
+        return {'dim': 0, 'ids': [], 'ivf_stale': []}
+
+    with open(idfile, 'r', encoding='utf-8') as file:
+        id_map = json.load(file)
+    id_map.setdefault('ivf_stale', [])
+
+    return id_map
+
+
+def add_to_vector_index(meetingid, tdocnumber, summary, tdoctext, embeddingfn=None):
+    """
+    Embeds the summary and the text of the TDoc and saves them in the vector index
+    The vectors of a TDoc already in the index are replaced.
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param summary (str): summary text
+    :param tdoctext (str): text of the TDoc (from get_tdoc_content)
+    :param embeddingfn (callable): embedding function (default from get_embedding_function)
+    :return err (str): error string (if any) otherwise an empty string
+    """
+    embeddingfn = embeddingfn or get_embedding_function()
+    datafolder = create_data_folder()
+    vector_file, id_file, ivf_file = get_index_files(datafolder)
+
+    try:
+        vectors = normalize_vectors(embeddingfn([summary, tdoctext[0:MAX_EMBEDDING_TEXT_LENGTH]]))
+    except Exception as e:
+        err = f"Embedding failed for {tdocnumber}: {e}"
+        logging.error(err)
+        return err
+
+    with lock_vector_index(datafolder):
+        id_map = load_id_map(id_file)
+        if id_map['dim'] and id_map['dim'] != vectors.shape[1]:
+            err = f"Embedding dimension {vectors.shape[1]} does not match the index dimension {id_map['dim']}"
+            logging.error(err)
+            return err
+        id_map['dim'] = vectors.shape[1]
+
+        positions = {tuple(vector_id): row for row, vector_id in enumerate(id_map['ids'])}
+        ivf_rows = get_ivf_rows(ivf_file)
+        for vector, kind in zip(vectors, [VECTOR_KIND_SUMMARY, VECTOR_KIND_TEXT]):
+            row = positions.get((meetingid, tdocnumber, kind))
+            if row is not None:
+                # Replace the vector in place
+                matrix = np.memmap(vector_file, dtype=np.float32, mode='r+', offset=row * vector.nbytes,
+                                   shape=vector.shape)
+                matrix[:] = vector
+                matrix.flush()
+                # The IVF codes of the row are not used until the next IVF build (the row is searched exactly)
+                if row < ivf_rows and row not in id_map['ivf_stale']:
+                    id_map['ivf_stale'].append(row)
+            else:
+                # Written at the row of the id map, the rows of an update which did not complete are overwritten
+                with open(vector_file, 'r+b' if os.path.exists(vector_file) else 'wb') as file:
+                    file.seek(len(id_map['ids']) * vector.nbytes)
+                    file.write(vector.tobytes())
+                    file.truncate()
+                id_map['ids'].append([meetingid, tdocnumber, kind])
+
+        # The id map is written last, readers only use the rows listed in the id map
+        write_id_map(id_file, id_map)
+
+    logging.info(f"Vector index updated: {meetingid}, {tdocnumber}, {len(id_map['ids'])} vectors")
+    return ''
+
+
+def load_vector_index():
+    """
+    Returns the memory-mapped matrix and the id map (cached until the id map or the IVF index file changes)
+    :return (dict): index_cache
+    """
+    vector_file, id_file, ivf_file = get_index_files(create_data_folder())
+    if not os.path.exists(id_file):
+        return index_cache
+
+    mtime = (os.path.getmtime(id_file), os.path.getmtime(ivf_file) if os.path.exists(ivf_file) else 0)
+    with index_lock:
+        if index_cache['mtime'] != mtime:
+            id_map = load_id_map(id_file)
+            rows = len(id_map['ids'])
+            index_cache['matrix'] = np.memmap(vector_file, dtype=np.float32, mode='r',
+                                              shape=(rows, id_map['dim'])) if rows else None
+            index_cache['ids'] = [tuple(vector_id) for vector_id in id_map['ids']]
+            index_cache['positions'] = {vector_id: row for row, vector_id in enumerate(index_cache['ids'])}
+            index_cache['ivf_stale'] = set(id_map['ivf_stale'])
+            index_cache['ivf'] = None
+            if os.path.exists(ivf_file):
+                with np.load(ivf_file) as ivf:
+                    index_cache['ivf'] = {key: ivf[key] for key in ivf.files}
+            index_cache['mtime'] = mtime
+
+    return index_cache
+
+
+def get_meeting_order(meetingid):
+    """
+    Returns a sort key of the meeting id (Example: '118' < '118bis' < '119')
+    :param meetingid (str): meeting id
+    :return (tuple): (meeting number, suffix)
+    """
+    match = re.match(r'(\d+)(.*)', meetingid)
+    if match is None:
+        return 0, meetingid
+
+    return int(match.group(1)), match.group(2)
+
+
+def get_ivf_rows(ivffile):
+    """
+    Returns the number of vectors in the IVF index file
+    :param ivffile (str): IVF index full path
+    :return (int): rows of the matrix in the IVF index, 0 if there is no IVF index
+    """
+    if not os.path.exists(ivffile):
+        return 0
+
+    with np.load(ivffile) as ivf:
+        return len(ivf['assignment'])
+
+
+def build_ivf_index(nlist=0, seed=0):
+    """
+    Builds the IVF index: k-means centroids of the vectors and int8 quantized vectors
+    Vectors added or replaced after the build are searched brute force until the next build.
+    :param nlist (int): number of centroids (default: square root of the number of vectors)
+    :param seed (int): random seed of the k-means initialization
+    :return rows (int): number of vectors in the IVF index
+    """
+    datafolder = create_data_folder()
+    vector_file, id_file, ivf_file = get_index_files(datafolder)
+    with lock_vector_index(datafolder):
+        id_map = load_id_map(id_file)
+        rows = len(id_map['ids'])
+        if rows == 0:
+            return 0
+
+        data = np.array(np.memmap(vector_file, dtype=np.float32, mode='r', shape=(rows, id_map['dim'])))
+        centroids, assignment, codes, scales = compute_ivf_index(data, nlist, seed)
+
+        temp_file = ivf_file + '.tmp.npz'
+        np.savez(temp_file, centroids=centroids, assignment=assignment.astype(np.int32), codes=codes,
+                 scales=scales.astype(np.float32))
+        os.replace(temp_file, ivf_file)
+        # All the rows are in the new IVF index
+        id_map['ivf_stale'] = []
+        write_id_map(id_file, id_map)
+    logging.info(f"IVF index built: {rows} vectors, {centroids.shape[0]} centroids")
+
+    return rows
+
+
+def compute_ivf_index(data, nlist, seed):
+    """
+    Computes the IVF index of the vectors
+    :param data (np.ndarray): float32 matrix of the vectors (unit length rows)
+    :param nlist (int): number of centroids (default: square root of the number of vectors)
+    :param seed (int): random seed of the k-means initialization
+    :return centroids (np.ndarray), assignment (np.ndarray), codes (np.ndarray), scales (np.ndarray):
+            centroids, centroid of each row, int8 quantized rows and their scale
+    """
+    rows = data.shape[0]
+    nlist = nlist or max(1, int(np.sqrt(rows)))
+
+    # k-means (spherical, the vectors have unit length)
+    generator = np.random.default_rng(seed)
+    centroids = data[generator.choice(rows, size=min(nlist, rows), replace=False)].copy()
+    for _ in range(IVF_KMEANS_ITERATIONS):
+        assignment = np.argmax(data @ centroids.T, axis=1)
+        for centroid in range(centroids.shape[0]):
+            members = data[assignment == centroid]
+            if len(members):
+                centroids[centroid] = members.mean(axis=0)
+        centroids = normalize_vectors(centroids)
+    assignment = np.argmax(data @ centroids.T, axis=1)
+
+    # int8 quantization with a scale per vector
+    scales = np.abs(data).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.round(data / scales[:, None]).astype(np.int8)
+
+    return centroids, assignment, codes, scales
+
+
+def get_candidate_rows(cache, query, count):
+    """
+    Returns the rows searched for the query: all rows, or the rows of the nearest IVF lists
+    (scored with the int8 vectors) and the rows added or replaced after the IVF build
+    :param cache (dict): index_cache
+    :param query (np.ndarray): query vector
+    :param count (int): number of results needed
+    :return (np.ndarray or None): row numbers, None to search all rows
+    """
+    ivf = cache['ivf']
+    rows = len(cache['ids'])
+    if ivf is None or rows < IVF_MIN_ROWS:
+        return None
+
+    ivf_rows = len(ivf['assignment'])
+    lists = np.argsort(ivf['centroids'] @ query)[::-1][:IVF_NPROBE]
+    candidates = np.nonzero(np.isin(ivf['assignment'], lists))[0]
+    # The IVF codes of the replaced rows are stale, these rows are searched exactly
+    stale = np.array(sorted(row for row in cache['ivf_stale'] if row < ivf_rows), dtype=np.int64)
+    candidates = candidates[~np.isin(candidates, stale)]
+
+    # Approximate scores with the int8 vectors, exact scores are calculated for the best ones
+    approximate = (ivf['codes'][candidates].astype(np.float32) @ query) * ivf['scales'][candidates]
+    keep = min(len(candidates), count * IVF_RERANK_FACTOR)
+    candidates = candidates[np.argpartition(-approximate, keep - 1)[:keep]] if keep else candidates
+
+    return np.concatenate([candidates, stale, np.arange(ivf_rows, rows)])
+
+
+def query_related_tdocs(meetingid, tdocnumber, k=5, earlieronly=True):
+    """
+    Finds the TDocs most similar to the summary of the TDoc (same or earlier meetings)
+    :param meetingid (str): meeting id
+    :param tdocnumber (str): tdoc number
+    :param k (int): number of related TDocs
+    :param earlieronly (bool): only TDocs of the same or earlier meetings
+    :return related (list): dicts with meeting_id, tdoc_number and score (cosine similarity), best first
+    """
+    cache = load_vector_index()
+    row = cache['positions'].get((meetingid, tdocnumber, VECTOR_KIND_SUMMARY))
+    if row is None or cache['matrix'] is None:
+        return []
+
+    matrix = cache['matrix']
+    query = np.array(matrix[row])
+    candidates = get_candidate_rows(cache, query, k)
+    scores = matrix @ query if candidates is None else matrix[candidates] @ query
+    rows = np.arange(len(scores)) if candidates is None else candidates
+    if len(scores) == 0:
+        return []
+
+    # Best rows first (more than k, a TDoc has a summary and a text vector)
+    count = min(len(scores), 4 * k + 2)
+    best = np.argpartition(-scores, count - 1)[:count] if count < len(scores) else np.arange(len(scores))
+    best = best[np.argsort(-scores[best])]
+
+    meeting_order = get_meeting_order(meetingid)
+    related = []
+    seen = {(meetingid, tdocnumber)}
+    for position in best:
+        related_meeting, related_tdoc, _ = cache['ids'][rows[position]]
+        if (related_meeting, related_tdoc) in seen:
+            continue
+        if earlieronly and get_meeting_order(related_meeting) > meeting_order:
+            continue
+        seen.add((related_meeting, related_tdoc))
+        related.append({'meeting_id': related_meeting, 'tdoc_number': related_tdoc,
+                        'score': float(scores[position])})
+        if len(related) == k:
+            break
+
+    return related
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TDoc Digest vector index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build-ivf', help='build the IVF index')
+    build_parser.add_argument('--nlist', type=int, default=0)
+    related_parser = subparsers.add_parser('related', help='related TDocs of a TDoc')
+    related_parser.add_argument('meetingid')
+    related_parser.add_argument('tdocnumber')
+    related_parser.add_argument('-k', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == 'build-ivf':
+        print(f"{build_ivf_index(args.nlist)} vectors indexed")
+    else:
+        for related_tdoc in query_related_tdocs(args.meetingid, args.tdocnumber, args.k):
+            print(f"{related_tdoc['meeting_id']} {related_tdoc['tdoc_number']} {related_tdoc['score']:.3f}")
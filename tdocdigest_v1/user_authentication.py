@@ -3,23 +3,37 @@ This file handles user authentication
 """
 import os
 import logging
+from manage_apikeys import get_api_keys, API_KEYS_ENV, API_KEY_ENV
+
+# Environment variable enabling the admin views (usage of the API keys), only set for an admin deployment
+ADMIN_ENV = 'TDOCDIGEST_ADMIN'
 
 
 # Get the user authenticated and return the respective key for the API
 def authenticate_user():
     """
-    Retrieve the openai API key from the environment
-    :return userkey (str): openai api key
+    Retrieve the openai API keys of the key pool from the environment (OPENAI_API_KEYS or OPENAI_API_KEY)
+    Each API call uses the least loaded key of the pool (see manage_apikeys)
+    :return userkey (str): first openai api key of the pool
     :return err (str): error message (if API key is not set)
     """
     err = ''
-    userkey = os.getenv("OPENAI_API_KEY")
+    keys = get_api_keys()
+    userkey = keys[0] if keys else None
     # Check if the API key is not found
     if not userkey:
-        err = f"Error: OPENAI_API_KEY environment variable is not set."
+        err = f"Error: {API_KEYS_ENV} or {API_KEY_ENV} environment variable is not set."
         logging.error(err)
     else:
-        logging.info("OPENAI_API_KEY successfully retrieved.")
+        logging.info(f"{len(keys)} OpenAI API keys successfully retrieved.")
 
     # return the API key and error
     return userkey, err
+
+
+def is_admin():
+    """
+    Checks whether the admin views are enabled (TDOCDIGEST_ADMIN=1), they are never enabled by a visitor
+    :return (bool): True for an admin deployment
+    """
+    return os.getenv(ADMIN_ENV, '') == '1'